@@ -0,0 +1,206 @@
+"""api_cache、utils和模型解析热路径的微基准测试
+
+在插件目录下运行 ``python -m benchmarks.microbenchmark``，
+结果保存在benchmarks/results下，并与上一次的结果对比
+"""
+import json
+import asyncio
+import tempfile
+import subprocess
+from json import dumps
+from pathlib import Path
+from timeit import Timer
+from itertools import count
+from typing import Dict, List, Callable
+from datetime import datetime, timezone, timedelta
+
+from pydantic import parse_raw_as
+
+from src import api_cache
+from src.logger import logger
+from src.models import CityWeatherApi
+from src.cache_codec import CacheCodec
+from src.series import HourlyWeatherSeries
+from src.cache_storage import SQLiteCacheStorage
+from src.utils import CacheKeyBuilder, DateTimeEncoder, generate_cache_name
+
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+REPEAT = 5
+ASYNC_BATCH = 1000
+
+
+def hourly_payload(hours: int) -> List[dict]:
+    """生成与和风天气逐小时预报返回值格式相同的数据"""
+    start = datetime(2024, 1, 1, 8, tzinfo=timezone(timedelta(hours=8)))
+    return [
+        {
+            'fxTime': (start + timedelta(hours=i)).isoformat(
+                timespec='minutes',
+            ),
+            'temp': str(i % 30),
+            'icon': '100',
+            'text': '晴',
+            'wind360': '90',
+            'windDir': '东风',
+            'windScale': '1-3',
+            'windSpeed': '10',
+            'humidity': '50',
+            'pop': str(i % 100),
+            'precip': '0.0',
+            'pressure': '1013',
+            'cloud': '10',
+            'dew': '-5',
+        }
+        for i in range(hours)
+    ]
+
+
+def parse_hourly(payload: List[dict]) -> List[CityWeatherApi.HourlyWeather]:
+    """与get_hourly_weather相同的解析方式"""
+    return [CityWeatherApi.HourlyWeather.parse_obj(data) for data in payload]
+
+
+def serialize(models: List[CityWeatherApi.HourlyWeather]) -> str:
+    """与use_cache相同的序列化方式"""
+    return dumps([data.dict() for data in models], cls=DateTimeEncoder)
+
+
+def bench(func: Callable[[], object]) -> float:
+    """返回单次调用的最短耗时，单位为us"""
+    timer = Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(REPEAT, number)) / number * 1e6
+
+
+def bench_async(loop: asyncio.AbstractEventLoop, func) -> float:
+    """在同一个事件循环中连续await多次，返回单次调用的最短耗时，单位为us"""
+
+    async def batch():
+        for _ in range(ASYNC_BATCH):
+            await func()
+
+    return bench(lambda: loop.run_until_complete(batch())) / ASYNC_BATCH
+
+
+def run() -> Dict[str, float]:
+    """运行所有基准测试"""
+    hourly_24h = hourly_payload(24)
+    hourly_168h = hourly_payload(168)
+    models_24h = parse_hourly(hourly_24h)
+    models_168h = parse_hourly(hourly_168h)
+    data_24h = serialize(models_24h)
+    codec = CacheCodec(List[CityWeatherApi.HourlyWeather])
+    encoded_24h = codec.encode(models_24h)
+    encoded_168h = codec.encode(models_168h)
+    series_codec = CacheCodec(HourlyWeatherSeries)
+    series_24h = series_codec.encode(HourlyWeatherSeries.from_rows(models_24h))
+    series_168h = series_codec.encode(
+        HourlyWeatherSeries.from_rows(models_168h),
+    )
+
+    @api_cache.use_cache(List[CityWeatherApi.HourlyWeather], 3600)
+    async def cached_hourly(location: str, *, lang: str = 'zh'):
+        return models_24h
+
+    build_key = CacheKeyBuilder(cached_hourly.__wrapped__)
+    results = {
+        'generate_cache_name': bench(
+            lambda: generate_cache_name(
+                'get_hourly_weather',
+                {'location': '101010100', 'lang': 'zh'},
+            ),
+        ),
+        'cache_key_builder': bench(
+            lambda: build_key(('101010100',), {'lang': 'zh'}),
+        ),
+        'parse_hourly_24h': bench(lambda: parse_hourly(hourly_24h)),
+        'parse_hourly_168h': bench(lambda: parse_hourly(hourly_168h)),
+        'serialize_hourly_24h': bench(lambda: serialize(models_24h)),
+        'serialize_hourly_168h': bench(lambda: serialize(models_168h)),
+        'deserialize_hourly_24h': bench(
+            lambda: parse_raw_as(
+                List[CityWeatherApi.HourlyWeather],
+                data_24h,
+            ),
+        ),
+        'codec_encode_hourly_24h': bench(lambda: codec.encode(models_24h)),
+        'codec_decode_hourly_24h': bench(lambda: codec.decode(encoded_24h)),
+        'codec_decode_hourly_168h': bench(
+            lambda: codec.decode(encoded_168h),
+        ),
+        'series_decode_hourly_24h': bench(
+            lambda: series_codec.decode(series_24h),
+        ),
+        'series_decode_hourly_168h': bench(
+            lambda: series_codec.decode(series_168h),
+        ),
+    }
+
+    loop = asyncio.new_event_loop()
+    locations = count()
+    results['use_cache_memory_hit'] = bench_async(
+        loop,
+        lambda: cached_hourly('101010100'),
+    )
+    # 内存缓存不保存任何条目，每次都从磁盘缓存读取
+    max_entries = api_cache.memory_cache.max_entries
+    api_cache.memory_cache.max_entries = 0
+    api_cache.memory_cache.clear()
+    results['use_cache_disk_hit'] = bench_async(
+        loop,
+        lambda: cached_hourly('101010100'),
+    )
+    api_cache.memory_cache.max_entries = max_entries
+    results['use_cache_miss'] = bench_async(
+        loop,
+        lambda: cached_hourly(str(next(locations))),
+    )
+    loop.close()
+    return results
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],  # noqa: S603, S607
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main() -> None:  # noqa: D103
+    # 日志输出会掩盖被测代码本身的耗时
+    logger.remove()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        storage = SQLiteCacheStorage(Path(tmp_dir) / 'cache.sqlite3')
+        api_cache.set_storage(storage)
+        results = run()
+        storage.close()
+
+    RESULTS_DIR.mkdir(exist_ok=True)
+    previous_files = sorted(RESULTS_DIR.glob('*.json'))
+    previous = (
+        json.loads(previous_files[-1].read_text())['results']
+        if previous_files
+        else {}
+    )
+    result_file = RESULTS_DIR / f'{datetime.now():%Y%m%d-%H%M%S}.json'
+    result_file.write_text(
+        json.dumps(
+            {'revision': _git_revision(), 'results': results},
+            indent=2,
+        ),
+    )
+    for name, cost in results.items():
+        line = f'{name:<28}{cost:>12.2f}us'
+        if name in previous:
+            line += f'{(cost / previous[name] - 1) * 100:>+10.1f}%'
+        print(line)  # noqa: T201
+    print(f'结果已保存到{result_file}')  # noqa: T201
+
+
+if __name__ == '__main__':
+    main()
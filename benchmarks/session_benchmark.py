@@ -0,0 +1,55 @@
+"""对比每次新建会话与共享连接池的单次请求延迟
+
+在插件目录下运行 ``python -m benchmarks.session_benchmark [次数]``，
+需要已填写HEFENG_KEY的config.yml
+"""
+import sys
+import asyncio
+from time import perf_counter
+from statistics import mean, median
+
+from aiohttp import ClientSession
+
+from src.config import config
+from src.api import GEO_API_URL
+from src.session import get_session, close_sessions
+
+URL = f'{GEO_API_URL}/city/lookup'
+PARAMS = {'key': config.HEFENG_KEY, 'location': '101010100', 'number': 1}
+
+
+async def _fresh_session_request() -> None:
+    async with ClientSession() as session, session.get(
+        URL,
+        params=PARAMS,
+    ) as resp:
+        await resp.read()
+
+
+async def _shared_session_request() -> None:
+    async with get_session(URL).get(URL, params=PARAMS) as resp:
+        await resp.read()
+
+
+async def _measure(request, times: int) -> list:
+    costs = []
+    for _ in range(times):
+        start = perf_counter()
+        await request()
+        costs.append((perf_counter() - start) * 1000)
+    return costs
+
+
+async def main(times: int) -> None:  # noqa: D103
+    fresh = await _measure(_fresh_session_request, times)
+    shared = await _measure(_shared_session_request, times)
+    await close_sessions()
+    for name, costs in (('每次新建会话', fresh), ('共享连接池', shared)):
+        print(  # noqa: T201
+            f'{name}: 平均{mean(costs):.1f}ms 中位数{median(costs):.1f}ms '
+            f'最大{max(costs):.1f}ms',
+        )
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20))
@@ -1,17 +1,50 @@
-from typing import Tuple, Union, Optional
+from time import perf_counter
+from collections import defaultdict
+from asyncio import Semaphore, gather
+from typing import (
+    Dict,
+    List,
+    Tuple,
+    Union,
+    TypeVar,
+    Callable,
+    Optional,
+    Awaitable,
+    DefaultDict,
+)
 
 from nonebot import NoneBot
 from aiocqhttp import Event as CQEvent
 from hoshino import Service, priv, get_bot  # type: ignore
 
-from .src.models import CityInfo
+from .src.config import config
+from .src.logger import logger
+from .src.metrics import metrics
 from .src.bot_send import bot_send
-from .src.api import get_city_info, get_now_weather, get_hourly_weather
-from .src.city_watch_list import (
-    add_watch_list,
-    get_watch_list,
-    get_watched_city,
-    remove_watch_list,
+from .src.series import HourlyWeatherSeries
+from .src.session import close_sessions, start_sessions
+from .src.city_alias import add_city_alias, flush_city_alias
+from .src.models import (
+    CityInfo,
+    AirQuality,
+    WeatherAlert,
+    MinutePrecipitation,
+)
+from .src.weather_alert import (
+    diff_alerts,
+    prune_alert_state,
+    flush_weather_alert,
+)
+from .src.nowcast import (
+    prune_rain_state,
+    update_rain_state,
+    upcoming_precipitation,
+)
+from .src.api_cache import (
+    sweep_cache,
+    close_storage,
+    upstream_calls,
+    start_legacy_cache_cleanup,
 )
 from .src.exceptions import (
     QueryFailedError,
@@ -20,16 +53,57 @@ from .src.exceptions import (
     MissingArgumentError,
     CityNotInWatchListError,
 )
+from .src.city_watch_list import (
+    add_watch_list,
+    get_watch_list,
+    get_city_groups,
+    flush_watch_list,
+    get_watched_city,
+    remove_watch_list,
+    get_watched_city_ids,
+)
+from .src.api import (
+    GEO_API_URL,
+    WEATHER_API_URL,
+    DAILY_WEATHER_DAYS,
+    resolve_city,
+    get_city_info,
+    get_air_quality,
+    get_now_weather,
+    get_daily_weather,
+    get_hourly_weather,
+    get_weather_alerts,
+    get_grid_now_weather,
+    get_minutely_precipitation,
+)
+from .src.render import (
+    render_forecast,
+    render_air_quality,
+    render_now_weather,
+    render_rain_change,
+    render_daily_weather,
+    render_hourly_weather,
+    render_weather_alerts,
+    render_grid_now_weather,
+    render_air_quality_brief,
+    render_hourly_precipitation,
+)
+
+# 每日天气支持的天数
+DAILY_DAYS_TEXT = '/'.join(days.rstrip('d') for days in DAILY_WEATHER_DAYS)
 
 # 帮助信息
 sv_help = (
-    '[地理位置]可为[城市]、[经度] [纬度]、[邮政编码]、[和风天气的城市id]\n'
+    '[地理位置]可为[城市]、[城市] [上级行政区]、[经度] [纬度]、[邮政编码]、'
+    '[和风天气的城市id]\n'
     '天气 [地理位置]：查询天气\n'
     '未来天气 [地理位置]：查询未来24小时天气\n'
     '未来降雨 [地理位置]：查询未来24小时降雨\n'
+    f'每日天气 [天数] [地理位置]：查询未来{DAILY_DAYS_TEXT}天天气，默认3天\n'
+    '空气质量 [地理位置]：查询空气质量和监测站数据\n'
     '设置默认城市 [地理位置]：设置默认城市，不指定地理位置则使用默认城市\n'
     '添加/删除群关注城市 [地理位置]：添加/删除群关注城市，'
-    '关注后会定时推送未来6小时天气预报\n'
+    '关注后会定时推送未来6小时天气预报、天气预警和短时降水提醒\n'
     '查看群城市关注：查看群城市关注'
 )
 
@@ -45,6 +119,40 @@ sv = Service(
 _bot: NoneBot = get_bot()
 
 
+@_bot.server_app.before_serving
+async def _on_startup():
+    start_sessions(GEO_API_URL, WEATHER_API_URL)
+    start_legacy_cache_cleanup()
+
+
+@_bot.server_app.after_serving
+async def _on_shutdown():
+    await close_sessions()
+    flush_watch_list()
+    flush_city_alias()
+    flush_weather_alert()
+    close_storage()
+
+
+def parse_coordinate(args: List[str]) -> Optional[str]:
+    """将[经度, 纬度]转换为接口使用的经纬度字符串，不是数字时返回None"""
+    try:
+        longitude, latitude = map(float, args)
+    except ValueError:
+        return None
+    if not (-180 <= longitude <= 180 and -90 <= latitude <= 90):
+        raise InvalidArgumentError
+    return f'{longitude},{latitude}'
+
+
+async def get_coordinate_city(coordinate: str) -> CityInfo:
+    """获取经纬度所在的城市"""
+    ret = await get_city_info(coordinate, result_number=1)
+    city = ret[0]
+    add_city_alias(city.city_id, city)
+    return city
+
+
 async def get_city(
     raw_message: str,
     user_id: Optional[Union[str, int]],
@@ -55,8 +163,8 @@ async def get_city(
     :param raw_message: 原始消息
 
     :return: CityInfo和对应的location
-    ，       输入为经纬度时，location为经纬度，输入为城市名时，location为城市名
-            name为城市名
+    ，       location为城市id
+            name为城市名，输入为经纬度时附带经纬度
     :rtype: Tuple[CityInfo, str]
     """
     args = raw_message.strip().split()
@@ -65,30 +173,27 @@ async def get_city(
         if user_id is None:
             raise InvalidArgumentError
         city_id = get_watched_city(user_id, group=False)
-        if city_id is None:
+        # 删除默认城市后保存的是空字符串
+        if not city_id:
             raise MissingArgumentError
-        ret = await get_city_info(city_id, result_number=1)
-        city = ret[0]
-        location = city.city_id
+        city = await resolve_city(city_id)
         name = city.name
     elif arg_count == 1:
-        ret = await get_city_info(args[0], result_number=1)
-        city = ret[0]
-        location = city.city_id
+        city = await resolve_city(args[0])
         name = city.name
     elif arg_count == 2:
-        try:
-            longitude, latitude = map(float, args)
-        except ValueError:
-            raise InvalidArgumentError from None
-        if not (-180 <= longitude <= 180 and -90 <= latitude <= 90):
-            raise InvalidArgumentError
-        location = f'{longitude},{latitude}'
-        ret = await get_city_info(location, result_number=1)
-        city = ret[0]
-        name = f'{city.name} ({location})'
+        coordinate = parse_coordinate(args)
+        if coordinate is None:
+            # 不是经纬度时视为[城市] [上级行政区]
+            city = await resolve_city(args[0], adm=args[1])
+            name = city.name
+        else:
+            city = await get_coordinate_city(coordinate)
+            name = f'{city.name} ({coordinate})'
     else:
         raise InvalidArgumentError
+    # 天气缓存统一使用城市id作为键
+    location = city.city_id
     return city, location, name
 
 
@@ -97,16 +202,20 @@ async def query_weather(bot: NoneBot, ev: CQEvent):  # noqa: D103
     msg = '发生意外错误'
     raw_message = ev.message.extract_plain_text()
     try:
-        city, location, name = await get_city(raw_message, ev.user_id)
-        ret = await get_now_weather(location)
-        msg = (
-            f'{name}的天气：\n'
-            f'{ret.weather_description}\n'
-            f'气温{ret.temperature}℃\n'
-            f'体感温度{ret.feels_temperature}℃\n'
-            f'湿度{ret.humidity}%\n'
-            f'云量{ret.cloud_amount}%'
-        )
+        args = raw_message.split()
+        coordinate = parse_coordinate(args) if len(args) == 2 else None
+        if coordinate is not None:
+            # 经纬度直接查询格点天气，同时查询城市名，只需一次往返
+            city, ret = await gather(
+                get_coordinate_city(coordinate),
+                get_grid_now_weather(coordinate),
+            )
+            name = f'{city.name} ({coordinate})'
+            msg = render_grid_now_weather(coordinate, name, ret)
+        else:
+            city, location, name = await get_city(raw_message, ev.user_id)
+            ret = await get_now_weather(location)
+            msg = render_now_weather(location, name, ret)
     except InvalidArgumentError:
         msg = (
             '错误的命令格式\n应为“天气 [地理位置]”\n[地理位置]可为[城市]、'
@@ -127,18 +236,7 @@ async def future_weather(bot: NoneBot, ev: CQEvent):  # noqa: D103
     try:
         city, location, name = await get_city(raw_message, ev.user_id)
         ret = await get_hourly_weather(location)
-        msg_list = [f'{name}的未来24h天气：']
-        for hourly_data in ret:
-            msg = (
-                f'-> {hourly_data.time.strftime("%H:%M")} '
-                f'{hourly_data.weather_description} '
-                f'{hourly_data.temperature}℃ '
-                f'湿度{hourly_data.humidity}% '
-                f'云量{hourly_data.cloud_amount}% '
-                f'降水概率{hourly_data.precipitation_probability}%'
-            )
-            msg_list.append(msg)
-        msg = '\n'.join(msg_list)
+        msg = render_hourly_weather(location, name, ret)
     except InvalidArgumentError:
         msg = (
             '错误的命令格式\n应为“小时天气 [地理位置]”\n[地理位置]可为[城市]、'
@@ -159,15 +257,7 @@ async def future_precipitation(bot: NoneBot, ev: CQEvent):  # noqa: D103
     try:
         city, location, name = await get_city(raw_message, ev.user_id)
         ret = await get_hourly_weather(location)
-        msg_list = [f'{name}的未来24h降雨：']
-        for hourly_data in ret:
-            msg = (
-                f'-> {hourly_data.time.strftime("%H:%M")} '
-                f'{hourly_data.weather_description} '
-                f'降水概率{hourly_data.precipitation_probability}%'
-            )
-            msg_list.append(msg)
-        msg = '\n'.join(msg_list)
+        msg = render_hourly_precipitation(location, name, ret)
     except InvalidArgumentError:
         msg = (
             '错误的命令格式\n应为“小时降雨 [地理位置]”\n[地理位置]可为[城市]、'
@@ -181,13 +271,64 @@ async def future_precipitation(bot: NoneBot, ev: CQEvent):  # noqa: D103
         await bot_send(bot, msg, ev=ev)
 
 
+@sv.on_prefix(['每日天气', '多日天气'])
+async def daily_weather(bot: NoneBot, ev: CQEvent):  # noqa: D103
+    msg = '发生意外错误'
+    raw_message = ev.message.extract_plain_text().strip()
+    days_arg, _, location = raw_message.partition(' ')
+    days_arg = days_arg.rstrip('天')
+    # 一两位数字视为天数，其余视为地理位置
+    if not (days_arg.isdigit() and len(days_arg) <= 2):
+        days_arg, location = '3', raw_message
+    days = f'{days_arg}d'
+    try:
+        if days not in DAILY_WEATHER_DAYS:
+            raise InvalidArgumentError
+        city, location, name = await get_city(location, ev.user_id)
+        ret = await get_daily_weather(location, days)
+        msg = render_daily_weather(location, name, days, ret)
+    except InvalidArgumentError:
+        msg = (
+            '错误的命令格式\n应为“每日天气 [天数] [地理位置]”\n'
+            f'[天数]可为{DAILY_DAYS_TEXT}\n[地理位置]可为[城市]、'
+            '[经度] [纬度]、[邮政编码]、[和风天气的城市id]'
+        )
+    except MissingArgumentError:
+        msg = '请指定城市或经纬度或设置默认城市'
+    except QueryFailedError as e:
+        msg = f'查询失败，{e}'
+    finally:
+        await bot_send(bot, msg, ev=ev)
+
+
+@sv.on_prefix(['空气质量', 'aqi', 'AQI'])
+async def query_air_quality(bot: NoneBot, ev: CQEvent):  # noqa: D103
+    msg = '发生意外错误'
+    raw_message = ev.message.extract_plain_text()
+    try:
+        city, location, name = await get_city(raw_message, ev.user_id)
+        ret = await get_air_quality(location)
+        msg = render_air_quality(location, name, ret)
+    except InvalidArgumentError:
+        msg = (
+            '错误的命令格式\n应为“空气质量 [地理位置]”\n[地理位置]可为[城市]、'
+            '[经度] [纬度]、[邮政编码]、[和风天气的城市id]'
+        )
+    except MissingArgumentError:
+        msg = '请指定城市或经纬度或设置默认城市'
+    except QueryFailedError as e:
+        msg = f'查询失败，{e}'
+    finally:
+        await bot_send(bot, msg, ev=ev)
+
+
 @sv.on_prefix(['设置默认城市'])
 async def set_default_city(bot: NoneBot, ev: CQEvent):  # noqa: D103
     msg = '发生意外错误'
     raw_message = ev.message.extract_plain_text()
     try:
         city, location, name = await get_city(raw_message, None)
-        add_watch_list(ev.user_id, city.city_id, group=False)
+        add_watch_list(ev.user_id, city, group=False)
         msg = f'已将{name}设置为默认城市'
     except CityInWatchListError:
         msg = f'{raw_message}已经是默认城市'
@@ -209,7 +350,7 @@ async def add_watch_city(bot: NoneBot, ev: CQEvent):  # noqa: D103
     raw_message = ev.message.extract_plain_text()
     try:
         city, location, name = await get_city(raw_message, None)
-        add_watch_list(ev.group_id, city.city_id)
+        add_watch_list(ev.group_id, city)
         msg = f'已添加{name}到关注列表'
     except CityInWatchListError:
         msg = f'{raw_message}已经在关注列表中'
@@ -257,36 +398,210 @@ async def show_watch_list(bot: NoneBot, ev: CQEvent):  # noqa: D103
         else:
             city_list = []
             for city_id in watch_list:
-                city = await get_city_info(city_id, result_number=1)
-                city_list.append(city[0].name)
+                city = await resolve_city(city_id)
+                city_list.append(city.name)
             msg = '关注列表：\n' + '，'.join(city_list)
     finally:
         await bot_send(bot, msg, ev=ev)
 
 
+@sv.on_fullmatch(['天气统计'])
+async def show_metrics(bot: NoneBot, ev: CQEvent):  # noqa: D103
+    if not priv.check_priv(ev, priv.SUPERUSER):
+        return
+    await bot_send(bot, metrics.render_summary(), ev=ev)
+
+
 # 定时任务
+JOB_SECONDS = 'hefeng_job_seconds'
+metrics.histogram(JOB_SECONDS, '定时任务耗时')
+
+T = TypeVar('T')
+
+
+async def fetch_watched_cities(
+    city_ids: List[str],
+    fetch: Callable[[str], Awaitable[T]],
+    job_name: str,
+) -> Dict[str, T]:
+    """限制并发数查询每个城市，返回城市id -> 查询结果
+
+    查询失败的城市记录日志后跳过
+    """
+    semaphore = Semaphore(config.SCHEDULED_JOB_CONCURRENCY)
+
+    async def limited_fetch(city_id: str) -> T:
+        async with semaphore:
+            return await fetch(city_id)
+
+    results = await gather(
+        *(limited_fetch(city_id) for city_id in city_ids),
+        return_exceptions=True,
+    )
+    city_results: Dict[str, T] = {}
+    for city_id, result in zip(city_ids, results):
+        if isinstance(result, BaseException):
+            logger.error(f'{job_name}查询{city_id}失败 {result!r}')
+            continue
+        city_results[city_id] = result
+    return city_results
+
+
 @sv.scheduled_job('cron', hour='7, 12, 16')
 async def hourly_weather_forcast():
     """每天7点、12点、18点推送天气预报"""
     watch_list = get_watch_list()
     if watch_list is None:
         return
+    start_time = perf_counter()
+    upstream_calls_before = sum(upstream_calls.values())
+    # 每个城市只查询一次
+    city_ids = get_watched_city_ids()
+
+    async def fetch(
+        city_id: str,
+    ) -> Tuple[
+        CityInfo,
+        HourlyWeatherSeries,
+        Optional[AirQuality.AirQualityInfo],
+    ]:
+        city = await resolve_city(city_id)
+        ret = await get_hourly_weather(city_id)
+        air_quality = None
+        if config.FORECAST_AIR_QUALITY:
+            # 空气质量只是附加信息，查询失败时不影响天气预报
+            try:
+                air_quality = await get_air_quality(city_id)
+            except QueryFailedError as e:
+                logger.warning(f'定时天气预报查询{city_id}空气质量失败 {e}')
+        return city, ret, air_quality
+
+    results = await fetch_watched_cities(city_ids, fetch, '定时天气预报')
+    city_msg = {}
+    for city_id, (city, ret, air_quality) in results.items():
+        city_msg[city_id] = render_forecast(city_id, city.name, ret)
+        if air_quality is not None:
+            city_msg[city_id] += '\n' + render_air_quality_brief(
+                city_id,
+                air_quality,
+            )
     for group_id, city_list in watch_list.items():
-        msg_list = []
-        for city_id in city_list:
-            city = await get_city_info(city_id, result_number=1)
-            detail_msg_list = [f'{city[0].name}的未来6h降雨：']
-            ret = await get_hourly_weather(city_id)
-            for hourly_data in ret[:6]:
-                msg = (
-                    f'-> {hourly_data.time.strftime("%H:%M")} '
-                    f'{hourly_data.weather_description} '
-                    f'{hourly_data.temperature}℃ '
-                    f'湿度{hourly_data.humidity}% '
-                    f'云量{hourly_data.cloud_amount}% '
-                    f'降水概率{hourly_data.precipitation_probability}%'
-                )
-                detail_msg_list.append(msg)
-            msg_list.append('\n'.join(detail_msg_list))
+        msg_list = [
+            city_msg[city_id] for city_id in city_list if city_id in city_msg
+        ]
+        if not msg_list:
+            continue
         msg = '\n----------\n'.join(msg_list)
         await bot_send(_bot, msg, target_id=group_id)
+    elapsed = perf_counter() - start_time
+    metrics.observe(JOB_SECONDS, elapsed, job='hourly_weather_forcast')
+    logger.info(
+        f'定时天气预报完成，用时{elapsed:.2f}s，'
+        f'共{len(city_ids)}个城市，'
+        f'上游请求{sum(upstream_calls.values()) - upstream_calls_before}次',
+    )
+
+
+async def poll_weather_alert():
+    """轮询群关注城市的天气预警，只推送新发布、更新和解除的预警"""
+    start_time = perf_counter()
+    city_ids = get_watched_city_ids()
+    prune_alert_state(city_ids)
+
+    async def fetch(city_id: str) -> Tuple[CityInfo, List[WeatherAlert]]:
+        city = await resolve_city(city_id)
+        alerts = await get_weather_alerts(city_id)
+        return city, alerts
+
+    results = await fetch_watched_cities(city_ids, fetch, '天气预警')
+    group_alerts: DefaultDict[str, List[Tuple[str, str, WeatherAlert]]] = (
+        defaultdict(list)
+    )
+    for city_id, (city, alerts) in results.items():
+        for change, alert in diff_alerts(city_id, alerts):
+            for group_id in get_city_groups(city_id):
+                group_alerts[group_id].append((city.name, change, alert))
+    for group_id, alerts in group_alerts.items():
+        await bot_send(
+            _bot,
+            render_weather_alerts(alerts),
+            target_id=group_id,
+        )
+    metrics.observe(
+        JOB_SECONDS,
+        perf_counter() - start_time,
+        job='poll_weather_alert',
+    )
+
+
+# 天气预警接口没有缓存，每个城市每次轮询都会请求一次接口，默认不启用
+if config.WEATHER_ALERT_INTERVAL > 0:
+    sv.scheduled_job('interval', seconds=config.WEATHER_ALERT_INTERVAL)(
+        poll_weather_alert,
+    )
+
+
+async def poll_nowcast():
+    """轮询群关注城市的分钟级降水，只在开始或停止降水时推送"""
+    start_time = perf_counter()
+    city_ids = get_watched_city_ids()
+    prune_rain_state(city_ids)
+
+    async def fetch(
+        city_id: str,
+    ) -> Tuple[CityInfo, List[MinutePrecipitation]]:
+        city = await resolve_city(city_id)
+        minutely = await get_minutely_precipitation(
+            f'{city.logtitude},{city.latitude}',
+        )
+        return city, minutely
+
+    results = await fetch_watched_cities(city_ids, fetch, '短时降水')
+    group_msg: DefaultDict[str, List[str]] = defaultdict(list)
+    for city_id, (city, minutely) in results.items():
+        precipitation = upcoming_precipitation(minutely)
+        if not update_rain_state(city_id, precipitation is not None):
+            continue
+        msg = render_rain_change(city.name, precipitation)
+        for group_id in get_city_groups(city_id):
+            group_msg[group_id].append(msg)
+    for group_id, msg_list in group_msg.items():
+        await bot_send(_bot, '\n'.join(msg_list), target_id=group_id)
+    metrics.observe(
+        JOB_SECONDS,
+        perf_counter() - start_time,
+        job='poll_nowcast',
+    )
+
+
+# 每个城市每次轮询都会请求一次接口，默认不启用
+if config.NOWCAST_INTERVAL > 0:
+    sv.scheduled_job('interval', seconds=config.NOWCAST_INTERVAL)(poll_nowcast)
+
+
+async def clean_cache():
+    """定时清理过期缓存"""
+    start_time = perf_counter()
+    await sweep_cache()
+    metrics.observe(
+        JOB_SECONDS,
+        perf_counter() - start_time,
+        job='clean_cache',
+    )
+
+
+if config.CACHE_SWEEP_INTERVAL > 0:
+    sv.scheduled_job('interval', seconds=config.CACHE_SWEEP_INTERVAL)(
+        clean_cache,
+    )
+
+
+async def export_metrics():
+    """定时导出Prometheus格式的指标文件"""
+    metrics.write_file()
+
+
+if config.METRICS_EXPORT_INTERVAL > 0:
+    sv.scheduled_job('interval', seconds=config.METRICS_EXPORT_INTERVAL)(
+        export_metrics,
+    )
@@ -1,13 +1,37 @@
-from typing import Any, Dict, List, Union, Optional
+import re
+from asyncio import Task
+from random import uniform
+from functools import wraps
+from urllib.parse import urlsplit
+from time import time, perf_counter
+from asyncio import sleep, ensure_future
+from typing import Any, Set, Dict, List, Tuple, Optional
+from asyncio import TimeoutError as RequestTimeoutError
 
-from aiohttp import ClientSession
+from aiohttp import ClientError
 from pydantic import parse_obj_as
 
 from .config import config
 from .logger import logger
-from .api_cache import use_cache
+from .metrics import metrics
+from .city_db import lookup_city
+from .session import get_session
+from .rate_limit import rate_limiter
+from .series import HourlyWeatherSeries
 from .exceptions import QueryFailedError
-from .models import CityInfo, CityWeatherApi
+from .api_cache import use_cache, cache_tier
+from .utils import seconds_until_next_update
+from .city_watch_list import get_city_snapshot, update_city_snapshot
+from .city_alias import add_city_alias, get_cached_city, get_aliased_city
+from .coordinate import COORDINATE_PATTERN, record_lookup, quantize_location
+from .models import (
+    CityInfo,
+    AirQuality,
+    WeatherAlert,
+    CityWeatherApi,
+    BlockWeatherApi,
+    MinutePrecipitation,
+)
 
 RET_CODE_INFO = {
     '204': '请求成功，但你查询的地区暂时没有你需要的数据。',
@@ -20,36 +44,122 @@ RET_CODE_INFO = {
     '500': '无响应或超时.',
 }
 
+GEO_API_URL = 'https://geoapi.qweather.com/v2'
+WEATHER_API_URL = (
+    f'https://{"dev" if config.FREE_SUBSCRIBE else ""}api.qweather.com/v7'
+)
+
+# 和风天气中国城市的id，用于跳过城市查询的快速路径
+CITY_ID_PATTERN = re.compile(r'^101\d{6}$')
+# 正在后台刷新的城市id
+_refreshing_cities: Set[str] = set()
+# 后台刷新任务，事件循环只保留任务的弱引用，需要在完成前持有
+_refresh_tasks: Set[Task] = set()
+
+# 需要重试的返回码
+RETRYABLE_CODES = {'429', '500'}
+
+API_REQUESTS = 'hefeng_api_requests_total'
+API_REQUEST_SECONDS = 'hefeng_api_request_seconds'
+metrics.counter(API_REQUESTS, '上游api请求次数')
+metrics.histogram(API_REQUEST_SECONDS, '上游api请求耗时')
+
 BASE_PARAMS = {
     'key': config.HEFENG_KEY,
 }
 
 
+def _quantize_location(func):
+    """location为经纬度时先量化，使相近的经纬度共用同一个缓存"""
+
+    @wraps(func)
+    async def wrapper(location: str, *args, **kwargs):
+        if not COORDINATE_PATTERN.match(location):
+            return await func(location, *args, **kwargs)
+        location = quantize_location(location)
+        ret = await func(location, *args, **kwargs)
+        # 直接使用被装饰函数本次查询的缓存结果，不额外查询缓存
+        record_lookup(func.__name__, cache_tier.get() != 'upstream')
+        return ret
+
+    return wrapper
+
+
+def _retry_delay(attempt: int) -> float:
+    """带随机抖动的指数退避时间"""
+    return uniform(
+        0,
+        min(config.RETRY_MAX_DELAY, config.RETRY_BASE_DELAY * 2**attempt),
+    )
+
+
+async def _request(url: str, params: Dict[str, Any]) -> Tuple[int, Dict]:
+    """发送一次请求，返回http状态码和返回值"""
+    endpoint = urlsplit(url).path
+    async with rate_limiter:
+        start_time = perf_counter()
+        try:
+            async with get_session(url).get(url, params=params) as resp:
+                logger.debug(f'使用{url}查询{params}')
+                status = resp.status
+                resp_content = {}
+                if status == 200:
+                    resp_content = await resp.json()
+                    logger.debug(f'返回值 {resp_content}')
+        except BaseException:
+            metrics.inc(API_REQUESTS, endpoint=endpoint, status='error')
+            raise
+        finally:
+            metrics.observe(
+                API_REQUEST_SECONDS,
+                perf_counter() - start_time,
+                endpoint=endpoint,
+            )
+    metrics.inc(
+        API_REQUESTS,
+        endpoint=endpoint,
+        status=resp_content.get('code', str(status)),
+    )
+    return status, resp_content
+
+
 async def _get(
     url: str,
     *,
     params: Optional[Dict[str, Any]] = None,
 ) -> Dict:
     params = {**BASE_PARAMS, **(params or {})}
-    async with ClientSession() as session, session.get(
-        url,
-        params=params,
-    ) as resp:
-        logger.debug(f'使用{url}查询{params}')
-        if resp.status != 200:
-            logger.error(f'查询失败 status code{resp.status}')
-            msg = '连接失败'
-            raise QueryFailedError(msg)
-        resp_content = await resp.json()
-        logger.debug(f'返回值 {resp_content}')
-        retcode = resp_content['code']
-        if retcode != '200':
-            retcode_info = RET_CODE_INFO[retcode]
-            logger.error(f'查询失败 retcode{retcode}{retcode_info}')
-            raise QueryFailedError(retcode_info)
-        return resp_content
+    for attempt in range(config.REQUEST_MAX_RETRIES + 1):
+        try:
+            status, resp_content = await _request(url, params)
+        except (ClientError, RequestTimeoutError) as e:
+            logger.error(f'查询失败 {e!r}')
+            status, resp_content = 500, {}
+        if status == 200:
+            retcode = resp_content['code']
+            if retcode == '200':
+                rate_limiter.on_success()
+                return resp_content
+        else:
+            logger.error(f'查询失败 status code{status}')
+            retcode = str(status)
+        if retcode == '429':
+            rate_limiter.on_throttled()
+        if retcode not in RETRYABLE_CODES and status < 500:
+            break
+        if attempt < config.REQUEST_MAX_RETRIES:
+            delay = _retry_delay(attempt)
+            logger.warning(f'查询失败 retcode{retcode}，{delay:.2f}s后重试')
+            await sleep(delay)
+    if status != 200:
+        msg = '连接失败'
+        raise QueryFailedError(msg)
+    retcode_info = RET_CODE_INFO.get(retcode, f'未知错误{retcode}')
+    logger.error(f'查询失败 retcode{retcode}{retcode_info}')
+    raise QueryFailedError(retcode_info)
 
 
+@_quantize_location
 @use_cache(List[CityInfo], config.CITY_INFO_TTL)
 async def get_city_info(
     location: str,
@@ -59,7 +169,7 @@ async def get_city_info(
     result_number: int = 5,
 ) -> List[CityInfo]:
     """使用城市id或经纬度查询城市信息"""
-    url = 'https://geoapi.qweather.com/v2/city/lookup'
+    url = f'{GEO_API_URL}/city/lookup'
     params = {
         'location': location,
         'adm': adm,
@@ -72,33 +182,172 @@ async def get_city_info(
     return parse_obj_as(List[CityInfo], resp['location'])
 
 
-@use_cache(CityWeatherApi.NowWeather, config.WEATHER_INFO_TTL)
+def _refresh_city_later(city_id: str) -> None:
+    """在后台重新查询城市信息，更新别名表和关注城市的信息"""
+    if city_id in _refreshing_cities:
+        return
+
+    async def refresh() -> None:
+        try:
+            city = (await get_city_info(city_id, result_number=1))[0]
+        except QueryFailedError as e:
+            logger.warning(f'后台刷新城市{city_id}失败 {e}')
+        else:
+            add_city_alias(city_id, city)
+            update_city_snapshot(city)
+        finally:
+            _refreshing_cities.discard(city_id)
+
+    _refreshing_cities.add(city_id)
+    task = ensure_future(refresh())
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+
+async def resolve_city(location: str, adm: Optional[str] = None) -> CityInfo:
+    """将城市名、拼音、邮政编码或城市id解析为城市信息
+
+    城市id直接使用关注列表或别名表中保存的城市信息，过期时在后台刷新；
+    其余依次使用本地别名表、离线城市数据库，均未命中时查询后记录别名
+
+    :param adm: 上级行政区，用于区分重名城市
+    """
+    if adm is None and CITY_ID_PATTERN.match(location):
+        snapshot = get_city_snapshot(location) or get_cached_city(location)
+        if snapshot is not None:
+            city, updated_at = snapshot
+            if time() - updated_at >= config.CITY_INFO_TTL:
+                _refresh_city_later(location)
+            return city
+    alias = location if adm is None else f'{location} {adm}'
+    city = get_aliased_city(alias) or lookup_city(location, adm)
+    if city is None:
+        city = (await get_city_info(location, adm=adm, result_number=1))[0]
+        add_city_alias(alias, city)
+        update_city_snapshot(city)
+    return city
+
+
+@use_cache(
+    CityWeatherApi.NowWeather,
+    config.WEATHER_INFO_TTL,
+    config.WEATHER_INFO_MAX_STALE,
+)
 async def get_now_weather(
     location: str,
 ) -> CityWeatherApi.NowWeather:
-    """使用城市id或经纬度查询城市天气"""
-    url = (
-        'https://'
-        f'{"dev"if config.FREE_SUBSCRIBE else ""}'
-        'api.qweather.com/v7/weather/now'
-    )
+    """使用城市id查询城市天气"""
+    url = f'{WEATHER_API_URL}/weather/now'
     params = {'location': location, 'lang': 'zh'}
     ret = await _get(url, params=params)
     return CityWeatherApi.NowWeather.parse_obj(ret['now'])
 
 
-@use_cache(List[CityWeatherApi.HourlyWeather], config.WEATHER_INFO_TTL)
+@use_cache(
+    HourlyWeatherSeries,
+    config.WEATHER_INFO_TTL,
+    config.WEATHER_INFO_MAX_STALE,
+)
 async def get_hourly_weather(
     location: str,
-) -> Union[str, List[CityWeatherApi.HourlyWeather]]:
-    """使用城市id或经纬度查询小时天气"""
-    url = (
-        'https://'
-        f'{"dev"if config.FREE_SUBSCRIBE else ""}'
-        'api.qweather.com/v7/weather/24h'
+) -> HourlyWeatherSeries:
+    """使用城市id查询小时天气"""
+    url = f'{WEATHER_API_URL}/weather/24h'
+    params = {'location': location, 'lang': 'zh'}
+    ret = await _get(url, params=params)
+    return HourlyWeatherSeries.from_rows(
+        parse_obj_as(List[CityWeatherApi.HourlyWeather], ret['hourly']),
+    )
+
+
+# 每日天气支持的预报天数，免费订阅不支持15天
+DAILY_WEATHER_DAYS = (
+    ('3d', '7d') if config.FREE_SUBSCRIBE else ('3d', '7d', '15d')
+)
+
+
+def _daily_weather_ttl() -> float:
+    """每日天气缓存到数据源下一次更新之后
+
+    数据源在整点之后才会发布新数据，过期时间推迟DAILY_WEATHER_UPDATE_DELAY分钟，
+    避免刚过整点时取到的旧数据被缓存到下一次更新
+    """
+    return seconds_until_next_update(
+        config.DAILY_WEATHER_UPDATE_HOURS,
+        config.DAILY_WEATHER_UPDATE_DELAY,
+        8,
     )
+
+
+@use_cache(
+    List[CityWeatherApi.DailyWeather],
+    _daily_weather_ttl,
+    config.WEATHER_INFO_MAX_STALE,
+)
+async def get_daily_weather(
+    location: str,
+    days: str = '3d',
+) -> List[CityWeatherApi.DailyWeather]:
+    """使用城市id查询每日天气，days为3d、7d或15d"""
+    url = f'{WEATHER_API_URL}/weather/{days}'
+    params = {'location': location, 'lang': 'zh'}
+    ret = await _get(url, params=params)
+    return parse_obj_as(List[CityWeatherApi.DailyWeather], ret['daily'])
+
+
+@_quantize_location
+@use_cache(
+    BlockWeatherApi.NowWeather,
+    config.WEATHER_INFO_TTL,
+    config.WEATHER_INFO_MAX_STALE,
+)
+async def get_grid_now_weather(
+    location: str,
+) -> BlockWeatherApi.NowWeather:
+    """使用经纬度查询格点天气，不需要先查询城市id"""
+    url = f'{WEATHER_API_URL}/grid-weather/now'
+    params = {'location': location, 'lang': 'zh'}
+    ret = await _get(url, params=params)
+    return BlockWeatherApi.NowWeather.parse_obj(ret['now'])
+
+
+@use_cache(
+    AirQuality.AirQualityInfo,
+    config.WEATHER_INFO_TTL,
+    config.WEATHER_INFO_MAX_STALE,
+)
+async def get_air_quality(location: str) -> AirQuality.AirQualityInfo:
+    """使用城市id查询城市空气质量和周边监测站数据"""
+    url = f'{WEATHER_API_URL}/air/now'
+    params = {'location': location, 'lang': 'zh'}
+    ret = await _get(url, params=params)
+    return AirQuality.AirQualityInfo.parse_obj(ret)
+
+
+# 分钟级降水每5分钟更新一次
+MINUTELY_INTERVAL = 300
+
+
+def _minutely_precipitation_ttl() -> float:
+    """分钟级降水缓存到下一个5分钟整点为止"""
+    return MINUTELY_INTERVAL - time() % MINUTELY_INTERVAL
+
+
+@_quantize_location
+@use_cache(List[MinutePrecipitation], _minutely_precipitation_ttl)
+async def get_minutely_precipitation(
+    location: str,
+) -> List[MinutePrecipitation]:
+    """使用经纬度查询未来2小时每5分钟的降水，仅支持中国"""
+    url = f'{WEATHER_API_URL}/minutely/5m'
+    params = {'location': location, 'lang': 'zh'}
+    ret = await _get(url, params=params)
+    return parse_obj_as(List[MinutePrecipitation], ret['minutely'])
+
+
+async def get_weather_alerts(location: str) -> List[WeatherAlert]:
+    """使用城市id查询当前生效的天气预警，不使用缓存"""
+    url = f'{WEATHER_API_URL}/warning/now'
     params = {'location': location, 'lang': 'zh'}
     ret = await _get(url, params=params)
-    return [
-        CityWeatherApi.HourlyWeather.parse_obj(data) for data in ret['hourly']
-    ]
+    return parse_obj_as(List[WeatherAlert], ret['warning'])
@@ -1,69 +1,387 @@
 from time import time
-from json import dumps
 from functools import wraps
-from inspect import signature
-from typing import Type, TypeVar, Optional
-
-from pydantic import BaseModel, parse_file_as
+from itertools import count
+from contextvars import ContextVar
+from collections import Counter, OrderedDict
+from asyncio import Task, sleep, shield, ensure_future, get_running_loop
+from typing import (
+    Any,
+    Dict,
+    List,
+    Type,
+    Tuple,
+    Union,
+    TypeVar,
+    Callable,
+    Hashable,
+    Optional,
+)
 
+from .config import config
 from .logger import logger
-from .define import CACHE_DIR
-from .utils import DateTimeEncoder, generate_cache_name
+from .metrics import metrics
+from .utils import CacheKeyBuilder
+from .cache_codec import CacheCodec
+from .cache_storage import (
+    CacheStorage,
+    create_storage,
+    remove_legacy_files,
+)
 
 T = TypeVar('T')
 
+# 当前调用由哪一级缓存返回：memory、disk或upstream，包括可直接返回的过期缓存
+cache_tier: ContextVar[str] = ContextVar('cache_tier', default='upstream')
+
+
+class MemoryCache:
+    """进程内的LRU缓存，保存已解析的模型对象，每个条目有独立的过期时间"""
+
+    def __init__(self, max_entries: int, max_size: int):  # noqa: D107
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        # key: (过期时间, 允许使用过期数据的截止时间, 大小, 值)
+        self._data: OrderedDict[Hashable, Tuple[float, float, int, Any]] = (
+            OrderedDict()
+        )
+        # id(值) -> 版本号，值在缓存中时id不会被复用，每次写入都分配新版本号
+        self._versions: Dict[int, int] = {}
+        self._next_version = count()
+
+    def __len__(self) -> int:  # noqa: D105
+        return len(self._data)
+
+    def version(self, value: Any) -> Optional[int]:
+        """获取缓存中的值的版本号，值不在缓存中时返回None
+
+        版本号不会重复，可以代替值本身判断数据是否已更新，而不必持有值的引用
+        """
+        return self._versions.get(id(value))
+
+    def get(self, key: Hashable) -> Optional[Tuple[Any, float]]:
+        """获取缓存及其过期时间，命中时将其移到最近使用的位置
+
+        超过允许使用过期数据的截止时间的条目会被移除
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expire_at, stale_until, _, value = entry
+        if stale_until <= time():
+            self.pop(key)
+            return None
+        self._data.move_to_end(key)
+        return value, expire_at
+
+    def set(  # noqa: A003
+        self,
+        key: Hashable,
+        value: Any,
+        expire_at: float,
+        size: int,
+        stale_until: Optional[float] = None,
+    ) -> None:
+        """写入缓存，超出条目数或大小限制时淘汰最久未使用的条目"""
+        self.pop(key)
+        if size > self.max_size:
+            return
+        if stale_until is None:
+            stale_until = expire_at
+        self._data[key] = (expire_at, stale_until, size, value)
+        self._versions[id(value)] = next(self._next_version)
+        self.size += size
+        while len(self._data) > self.max_entries or self.size > self.max_size:
+            self.pop(next(iter(self._data)))
+
+    def pop(self, key: Hashable) -> None:
+        """移除缓存"""
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+            self._versions.pop(id(entry[3]), None)
+
+    def clear(self) -> None:
+        """清空缓存"""
+        self._data.clear()
+        self._versions.clear()
+        self.size = 0
+
+    def evict_expired(self) -> int:
+        """移除所有超过允许使用过期数据截止时间的条目，返回移除的条目数"""
+        now = time()
+        expired = [
+            key
+            for key, (_, stale_until, _, _) in self._data.items()
+            if stale_until <= now
+        ]
+        for key in expired:
+            self.pop(key)
+        return len(expired)
+
+
+memory_cache = MemoryCache(
+    config.MEMORY_CACHE_MAX_ENTRIES,
+    config.MEMORY_CACHE_MAX_SIZE,
+)
+
+
+# 正在进行的上游请求，同一缓存键的并发未命中共享同一个请求
+_inflight: Dict[Tuple, Task] = {}
+# 各函数命中内存缓存/磁盘缓存的次数
+memory_hits: Counter = Counter()
+disk_hits: Counter = Counter()
+# 各函数实际发起的上游请求数
+upstream_calls: Counter = Counter()
+# 各函数因合并并发请求而节省的上游请求数
+coalesced_calls: Counter = Counter()
+# 各函数返回过期数据并在后台刷新的次数
+stale_hits: Counter = Counter()
+
+
+def _collect_cache_requests() -> List[Tuple[Dict[str, str], float]]:
+    results = (
+        ('memory_hit', memory_hits),
+        ('disk_hit', disk_hits),
+        ('stale', stale_hits),
+        ('coalesced', coalesced_calls),
+        ('miss', upstream_calls),
+    )
+    return [
+        ({'function': function, 'result': result}, count)
+        for result, counter in results
+        for function, count in counter.items()
+    ]
+
+
+metrics.collector(
+    'hefeng_cache_requests_total',
+    'counter',
+    '缓存请求次数',
+    _collect_cache_requests,
+)
+metrics.collector(
+    'hefeng_memory_cache_entries',
+    'gauge',
+    '内存缓存条目数',
+    lambda: [({}, len(memory_cache))],
+)
+
+_storage: Optional[CacheStorage] = None
+
+
+def get_storage() -> CacheStorage:
+    """获取缓存存储后端，第一次使用时才创建，导入模块时不会创建数据库"""
+    global _storage
+    if _storage is None:
+        _storage = create_storage()
+    return _storage
+
+
+def set_storage(storage: CacheStorage) -> None:
+    """替换缓存存储后端，用于基准测试等需要隔离真实缓存的场合"""
+    global _storage
+    _storage = storage
 
-def save_cache(name: str, data: str) -> None:
+
+def close_storage() -> None:
+    """关闭已创建的缓存存储后端，没有创建过时不会为此创建"""
+    global _storage
+    if _storage is not None:
+        _storage.close()
+        _storage = None
+
+
+def save_cache(name: str, data: str, expire_at: float) -> None:
     """保存缓存"""
-    if not CACHE_DIR.exists():
-        CACHE_DIR.mkdir()
-    cache_file = CACHE_DIR / f'{name}.cache'
-    with cache_file.open('w', encoding='utf-8') as f:
-        f.write(data)
+    get_storage().set(name, data, expire_at)
+
+
+def get_cache(
+    name: str,
+    codec: CacheCodec[T],
+    max_stale: int = 0,
+) -> Optional[Tuple[T, float, int]]:
+    """获取缓存，返回缓存、过期时间和数据大小
+
+    过期不超过max_stale秒的缓存仍会返回，由调用方根据过期时间判断是否需要刷新，
+    无法解码的缓存视为不存在
+    """
+    entry = get_storage().get(name)
+    if entry is None:
+        return None
+    data, expire_at = entry
+    if time() >= expire_at + max_stale:
+        return None
+    try:
+        return codec.decode(data), expire_at, len(data)
+    except ValueError:
+        logger.warning(f'缓存{name}无法解码，已忽略')
+        return None
+
 
+def _log_refresh_error(task: Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f'后台刷新缓存失败 {task.exception()!r}')
 
-def get_cache(name: str, model: Type[T], ttl: int) -> Optional[T]:
-    """获取缓存"""
-    cache_file = CACHE_DIR / f'{name}.cache'
-    if cache_file.exists() and time() - cache_file.stat().st_ctime < ttl:
-        return parse_file_as(model, cache_file)
-    return None
 
+def use_cache(
+    model: Type[T],
+    ttl: Union[int, Callable[[], float]],
+    max_stale: int = 0,
+):
+    """装饰器，依次查询内存缓存、磁盘缓存，均未命中时调用原函数
 
-def use_cache(model: Type[T], ttl: int):
-    """装饰器"""
+    ttl可以是返回本次缓存有效秒数的函数，用于按数据源的更新时间对齐过期时间
+
+    max_stale大于0时启用stale-while-revalidate：
+    过期不超过max_stale秒的缓存会被直接返回，同时在后台刷新
+    """
 
     def decorator(func):
-        @wraps(func)
-        async def wrapper(*args, **kwargs):
-            cache_name = generate_cache_name(
-                func.__name__,
-                signature(func).bind(*args, **kwargs).arguments,
+        build_key = CacheKeyBuilder(func)
+        codec = CacheCodec(model)
+
+        async def fetch(key: Tuple, args: tuple, kwargs: dict):
+            upstream_calls[func.__name__] += 1
+            cache = await func(*args, **kwargs)
+            data = codec.encode(cache)
+            expire_at = time() + (ttl() if callable(ttl) else ttl)
+            save_cache(build_key.cache_name(key), data, expire_at)
+            memory_cache.set(
+                key,
+                cache,
+                expire_at,
+                len(data),
+                expire_at + max_stale,
             )
-            cache = get_cache(cache_name, model, ttl)
-            if cache is None:
-                cache = await func(*args, **kwargs)
-                if isinstance(cache, BaseModel):
-                    data = cache.json()
-                # elif isinstance(cache, list):
-                else:  # 目前其余情况只有List[Model]
-                    data = dumps(
-                        [data.dict() for data in cache],
-                        cls=DateTimeEncoder,
-                    )
-                save_cache(cache_name, data)
-            else:
-                logger.debug(f'{func.__name__} 使用缓存')
             return cache
 
+        def start_fetch(key: Tuple, args: tuple, kwargs: dict) -> Task:
+            task = _inflight.get(key)
+            if task is None:
+                task = ensure_future(fetch(key, args, kwargs))
+                _inflight[key] = task
+                task.add_done_callback(
+                    lambda _: _inflight.pop(key, None),
+                )
+            else:
+                coalesced_calls[func.__name__] += 1
+                logger.debug(f'{func.__name__} 合并并发请求')
+            return task
+
+        def use_stale(key: Tuple, args: tuple, kwargs: dict) -> None:
+            stale_hits[func.__name__] += 1
+            logger.debug(f'{func.__name__} 使用过期缓存并在后台刷新')
+            if key not in _inflight:
+                start_fetch(key, args, kwargs).add_done_callback(
+                    _log_refresh_error,
+                )
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = build_key(args, kwargs)
+            memory_hit = memory_cache.get(key)
+            if memory_hit is not None:
+                cache, expire_at = memory_hit
+                if expire_at <= time():
+                    use_stale(key, args, kwargs)
+                else:
+                    memory_hits[func.__name__] += 1
+                    logger.debug(f'{func.__name__} 使用内存缓存')
+                cache_tier.set('memory')
+                return cache
+            disk_hit = get_cache(build_key.cache_name(key), codec, max_stale)
+            if disk_hit is not None:
+                cache, expire_at, size = disk_hit
+                memory_cache.set(
+                    key,
+                    cache,
+                    expire_at,
+                    size,
+                    expire_at + max_stale,
+                )
+                if expire_at <= time():
+                    use_stale(key, args, kwargs)
+                else:
+                    disk_hits[func.__name__] += 1
+                    logger.debug(f'{func.__name__} 使用缓存')
+                cache_tier.set('disk')
+                return cache
+            cache_tier.set('upstream')
+            # shield使单个调用方被取消时不会取消其他调用方共享的请求
+            return await shield(start_fetch(key, args, kwargs))
+
         return wrapper
 
     return decorator
 
 
-# 还没想好怎么用
-# def clear_cache(name: str) -> None:
-#     """清除缓存"""
-#     cache_file = CACHE_DIR / f'{name}.cache'
-#     if cache_file.exists():
-#         cache_file.unlink()
+async def sweep_cache() -> None:
+    """清理过期的磁盘缓存，并按最久未访问淘汰超出容量上限的缓存
+
+    每批删除后让出事件循环，避免长时间阻塞
+    """
+    batch_size = config.CACHE_SWEEP_BATCH_SIZE
+    memory_evicted = memory_cache.evict_expired()
+    # 仍可能作为过期数据返回的缓存不清理
+    before = time() - config.WEATHER_INFO_MAX_STALE
+    storage = get_storage()
+    expired_count = expired_size = 0
+    while True:
+        count, size = storage.delete_expired(before, batch_size)
+        expired_count += count
+        expired_size += size
+        if count < batch_size:
+            break
+        await sleep(0)
+    evicted_count = evicted_size = 0
+    entries, total_size = storage.usage()
+    while (
+        entries > config.CACHE_MAX_ENTRIES
+        or total_size > config.CACHE_MAX_SIZE
+    ):
+        limit = batch_size
+        if total_size <= config.CACHE_MAX_SIZE:
+            limit = min(limit, entries - config.CACHE_MAX_ENTRIES)
+        count, size = storage.delete_least_recently_used(limit)
+        if count == 0:
+            break
+        entries -= count
+        total_size -= size
+        evicted_count += count
+        evicted_size += size
+        await sleep(0)
+    if memory_evicted or expired_count or evicted_count:
+        logger.info(
+            f'清理缓存：内存缓存过期{memory_evicted}条，'
+            f'磁盘缓存过期{expired_count}条（{expired_size}字节），'
+            f'超出容量淘汰{evicted_count}条（{evicted_size}字节）',
+        )
+
+
+_legacy_cleanup: Optional[Task] = None
+
+
+async def _remove_legacy_files() -> None:
+    try:
+        count = await get_running_loop().run_in_executor(
+            None,
+            remove_legacy_files,
+        )
+    except OSError as e:
+        logger.warning(f'删除旧版缓存文件失败 {e!r}')
+        return
+    if count:
+        logger.info(f'已删除{count}个旧版缓存文件')
+
+
+def start_legacy_cache_cleanup() -> None:
+    """在后台线程删除旧版每个缓存一个文件的缓存，不阻塞事件循环和缓存读取
+
+    只在使用SQLite存储时删除，文件存储仍在使用这些文件
+    """
+    global _legacy_cleanup
+    if config.CACHE_BACKEND != 'sqlite' or _legacy_cleanup is not None:
+        return
+    _legacy_cleanup = ensure_future(_remove_legacy_files())
@@ -1,6 +1,16 @@
-from asyncio import sleep
 from random import uniform
-from typing import Union, Literal, Optional
+from time import monotonic
+from collections import deque
+from asyncio import Task, Semaphore, sleep, ensure_future
+from typing import (
+    Dict,
+    Deque,
+    Tuple,
+    Union,
+    Literal,
+    Optional,
+    NamedTuple,
+)
 
 from nonebot import NoneBot
 from aiocqhttp import ActionFailed
@@ -8,9 +18,8 @@ from aiocqhttp import Event as CQEvent
 
 from .config import config
 from .logger import logger
+from .metrics import metrics
 
-_sending_message = False
-_pending_message = []
 if config.SEND_MESSAGE_INTERVAL:
     _interval_offset = 0.1 * config.SEND_MESSAGE_INTERVAL
     _interval = (
@@ -20,15 +29,63 @@ if config.SEND_MESSAGE_INTERVAL:
 else:
     _interval = None
 
+TargetKey = Tuple[str, int]
 
-async def _send_message(
-    bot: NoneBot,
-    message: str,
-    *,
-    ev: Optional[CQEvent] = None,
-    target_type: Literal['group', 'private'] = 'group',
-    target_id: Optional[Union[int, str]] = None,
-):
+
+class _PendingMessage(NamedTuple):
+    bot: NoneBot
+    message: str
+    ev: Optional[CQEvent]
+    target_type: Literal['group', 'private']
+    target_id: Optional[Union[int, str]]
+    enqueued_at: float
+
+
+# 每个发送目标一个队列和一个发送任务，不同目标之间并发发送
+_queues: Dict[TargetKey, Deque[_PendingMessage]] = {}
+_workers: Dict[TargetKey, Task] = {}
+_send_semaphore = Semaphore(config.SEND_MAX_CONCURRENCY)
+send_stats = {
+    'sent': 0,
+    'failed': 0,
+}
+
+SEND_DELAY_SECONDS = 'hefeng_send_delay_seconds'
+metrics.histogram(SEND_DELAY_SECONDS, '消息从进入队列到发送的延迟')
+SEND_SECONDS = 'hefeng_send_seconds'
+metrics.histogram(SEND_SECONDS, '调用发送消息接口的耗时')
+metrics.collector(
+    'hefeng_send_messages_total',
+    'counter',
+    '发送消息数',
+    lambda: [
+        ({'result': 'sent'}, send_stats['sent']),
+        ({'result': 'failed'}, send_stats['failed']),
+    ],
+)
+metrics.collector(
+    'hefeng_send_queue_depth',
+    'gauge',
+    '等待发送的消息数',
+    lambda: [({}, sum(len(queue) for queue in _queues.values()))],
+)
+
+
+def _target_key(
+    ev: Optional[CQEvent],
+    target_type: Literal['group', 'private'],
+    target_id: Optional[Union[int, str]],
+) -> TargetKey:
+    if ev is not None:
+        if ev.group_id:
+            return 'group', int(ev.group_id)
+        return 'private', int(ev.user_id)
+    return target_type, int(target_id)
+
+
+async def _send_message(pending: _PendingMessage) -> str:
+    """发送一条消息，返回发送结果sent或failed"""
+    bot, message, ev, target_type, target_id, _ = pending
     try:
         if ev is not None:
             await bot.send(ev, message)
@@ -37,25 +94,41 @@ async def _send_message(
         elif target_type == 'private':
             await bot.send_private_msg(user_id=int(target_id), message=message)
     except ActionFailed:
-        target = ev.group_id if ev.group_id else target_id
+        target = _target_key(ev, target_type, target_id)[1]
         logger.error(f'向{target}发送消息{message}失败')
+        result = 'failed'
+    except Exception as e:
+        # 网络错误等异常不能结束发送任务，否则队列中剩余的消息会被丢弃
+        target = _target_key(ev, target_type, target_id)[1]
+        logger.error(f'向{target}发送消息{message}时出错 {e!r}')
+        result = 'failed'
+    else:
+        result = 'sent'
+    send_stats[result] += 1
+    return result
 
 
-async def _run_pending_tasks():
-    global _sending_message
-    global _pending_message
-    if _sending_message:
-        return
-    _sending_message = True
-    while _pending_message:
-        await _pending_message.pop(0)
-        if _interval is not None:
-            await sleep(
-                uniform(
-                    *_interval,
-                ),
-            )
-    _sending_message = False
+async def _run_queue(key: TargetKey) -> None:
+    """依次发送某个目标的消息，队列为空时退出"""
+    queue = _queues[key]
+    try:
+        while queue:
+            pending = queue.popleft()
+            async with _send_semaphore:
+                delay = monotonic() - pending.enqueued_at
+                metrics.observe(SEND_DELAY_SECONDS, delay)
+                start_time = monotonic()
+                result = await _send_message(pending)
+                metrics.observe(
+                    SEND_SECONDS,
+                    monotonic() - start_time,
+                    result=result,
+                )
+            if _interval is not None and queue:
+                await sleep(uniform(*_interval))
+    finally:
+        del _queues[key]
+        del _workers[key]
 
 
 async def bot_send(
@@ -66,17 +139,19 @@ async def bot_send(
     target_type: Literal['group', 'private'] = 'group',
     target_id: Optional[Union[int, str]] = None,
 ):
-    """bot发送消息的封装，用于控制消息发送频率，现在已意义不大"""
+    """bot发送消息的封装，消息按目标排队，在后台发送
+
+    同一目标的消息按顺序发送并受SEND_MESSAGE_INTERVAL限制，
+    不同目标之间并发发送，总并发数受SEND_MAX_CONCURRENCY限制
+    """
     if ev is None and target_id is None:
         error_msg = '发送消息未指定目标！'
         raise AssertionError(error_msg)
-    _pending_message.append(
-        _send_message(
-            bot,
-            message,
-            ev=ev,
-            target_type=target_type,
-            target_id=target_id,
-        ),
+    key = _target_key(ev, target_type, target_id)
+    if key not in _queues:
+        _queues[key] = deque()
+    _queues[key].append(
+        _PendingMessage(bot, message, ev, target_type, target_id, monotonic()),
     )
-    await _run_pending_tasks()
+    if key not in _workers:
+        _workers[key] = ensure_future(_run_queue(key))
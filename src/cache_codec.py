@@ -0,0 +1,119 @@
+from hashlib import md5
+from json import dumps, loads
+from datetime import date, time, datetime
+from typing import Any, List, Type, Generic, TypeVar, get_args, get_origin
+
+from pydantic import BaseModel, ValidationError, parse_raw_as
+
+from .utils import DateTimeEncoder, construct_trusted
+from .series import HourlyWeather, HourlyWeatherSeries
+
+try:
+    import orjson
+except ImportError:  # orjson为可选依赖
+    orjson = None
+
+T = TypeVar('T')
+
+# 缓存格式改变时增加版本号，旧版本的缓存会经过完整校验后再使用
+CACHE_FORMAT_VERSION = 1
+
+
+def _dumps(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return dumps(obj, cls=DateTimeEncoder, separators=(',', ':'))
+
+
+def _loads(data: str) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return loads(data)
+
+
+class CacheCodec(Generic[T]):
+    """缓存的编码与解码
+
+    缓存以'v版本号:布局:模型指纹'为首行，之后为按字段名保存的json。
+    首行与当前版本和模型一致时视为自己写入的可信数据，
+    跳过校验直接构造模型；否则（包括旧版无首行的缓存）经过完整校验
+    """
+
+    def __init__(self, model: Type[T]):  # noqa: D107
+        self.model = model
+        # 按列保存的序列，旧版缓存按对应的模型列表校验
+        self._is_series = model is HourlyWeatherSeries
+        if self._is_series:
+            self._validate_model = List[HourlyWeather]
+        else:
+            self._validate_model = model
+        self._is_list = get_origin(self._validate_model) in (list, List)
+        self._item_model: Type[BaseModel] = (
+            get_args(self._validate_model)[0] if self._is_list else model
+        )
+        fields = self._item_model.__fields__
+        # 日期时间字段在json中保存为iso格式字符串
+        self._temporal_fields = [
+            (name, field.type_.fromisoformat)
+            for name, field in fields.items()
+            if field.type_ in (date, time, datetime)
+        ]
+        # 含有嵌套模型的数据按字典保存，读取时经过校验
+        self._is_nested = not self._is_list and any(
+            isinstance(field.type_, type)
+            and issubclass(field.type_, BaseModel)
+            for field in fields.values()
+        )
+        fingerprint = md5(
+            ','.join(
+                f'{name}:{field.outer_type_}' for name, field in fields.items()
+            ).encode(),
+        ).hexdigest()[:8]
+        if self._is_series:
+            layout = 'columns'
+        elif self._is_nested:
+            layout = 'nested'
+        else:
+            layout = 'rows'
+        self.header = f'v{CACHE_FORMAT_VERSION}:{layout}:{fingerprint}\n'
+
+    def encode(self, value: T) -> str:
+        """编码为缓存数据"""
+        if self._is_series:
+            payload = value.to_columns()
+        elif self._is_nested:
+            payload = value.dict()
+        elif self._is_list:
+            payload = [item.__dict__ for item in value]
+        else:
+            payload = value.__dict__
+        return self.header + _dumps(payload)
+
+    def _construct(self, fields: dict) -> BaseModel:
+        for name, parse in self._temporal_fields:
+            value = fields[name]
+            if value is not None:
+                fields[name] = parse(value)
+        return construct_trusted(self._item_model, fields)
+
+    def decode(self, data: str) -> T:
+        """解码缓存数据，数据无法通过校验时抛出ValueError"""
+        if data.startswith(self.header):
+            payload = _loads(data[len(self.header) :])
+            if self._is_series:
+                return HourlyWeatherSeries.from_columns(payload)
+            if self._is_nested:
+                return self.model.parse_obj(payload)
+            if self._is_list:
+                return [self._construct(fields) for fields in payload]
+            return self._construct(payload)
+        # 版本不一致或旧版缓存，去掉首行后完整校验
+        if data.startswith('v'):
+            data = data.split('\n', 1)[-1]
+        try:
+            value = parse_raw_as(self._validate_model, data)
+        except ValidationError as e:
+            raise ValueError(str(e)) from e
+        if self._is_series:
+            return HourlyWeatherSeries.from_rows(value)
+        return value
@@ -0,0 +1,236 @@
+import sqlite3
+from os import utime
+from time import time
+from pathlib import Path
+from typing import Tuple, Optional
+from abc import ABC, abstractmethod
+
+from .config import config
+from .define import CACHE_DIR, CACHE_DB_PATH
+
+
+class CacheStorage(ABC):
+    """缓存存储后端，保存序列化后的缓存及其过期时间"""
+
+    @abstractmethod
+    def get(self, name: str) -> Optional[Tuple[str, float]]:
+        """获取缓存数据和过期时间，并记录访问时间"""
+
+    @abstractmethod
+    def set(  # noqa: A003
+        self,
+        name: str,
+        data: str,
+        expire_at: float,
+    ) -> None:
+        """保存缓存"""
+
+    @abstractmethod
+    def delete_expired(self, before: float, limit: int) -> Tuple[int, int]:
+        """删除至多limit条过期时间早于before的缓存
+
+        :return: 删除的条目数和字节数
+        """
+
+    @abstractmethod
+    def delete_least_recently_used(self, limit: int) -> Tuple[int, int]:
+        """删除至多limit条最久未访问的缓存
+
+        :return: 删除的条目数和字节数
+        """
+
+    @abstractmethod
+    def usage(self) -> Tuple[int, int]:
+        """获取缓存的总条目数和总字节数"""
+
+    def close(self) -> None:  # noqa: B027
+        """关闭存储，默认不需要关闭"""
+
+
+class FileCacheStorage(CacheStorage):
+    """每个缓存一个文件，过期时间记录在文件的修改时间上"""
+
+    def _path(self, name: str):
+        return CACHE_DIR / f'{name}.cache'
+
+    def get(self, name: str) -> Optional[Tuple[str, float]]:  # noqa: D102
+        cache_file = self._path(name)
+        if not cache_file.exists():
+            return None
+        expire_at = cache_file.stat().st_mtime
+        utime(cache_file, (time(), expire_at))
+        return cache_file.read_text(encoding='utf-8'), expire_at
+
+    def set(  # noqa: A003, D102
+        self,
+        name: str,
+        data: str,
+        expire_at: float,
+    ) -> None:
+        if not CACHE_DIR.exists():
+            CACHE_DIR.mkdir()
+        cache_file = self._path(name)
+        cache_file.write_text(data, encoding='utf-8')
+        utime(cache_file, (time(), expire_at))
+
+    def delete_expired(  # noqa: D102
+        self,
+        before: float,
+        limit: int,
+    ) -> Tuple[int, int]:
+        count = size = 0
+        for cache_file in CACHE_DIR.glob('*.cache'):
+            stat = cache_file.stat()
+            if stat.st_mtime < before:
+                cache_file.unlink()
+                count += 1
+                size += stat.st_size
+                if count >= limit:
+                    break
+        return count, size
+
+    def delete_least_recently_used(  # noqa: D102
+        self,
+        limit: int,
+    ) -> Tuple[int, int]:
+        cache_files = sorted(
+            (
+                (cache_file, cache_file.stat())
+                for cache_file in CACHE_DIR.glob('*.cache')
+            ),
+            key=lambda item: item[1].st_atime,
+        )[:limit]
+        for cache_file, _ in cache_files:
+            cache_file.unlink()
+        return len(cache_files), sum(stat.st_size for _, stat in cache_files)
+
+    def usage(self) -> Tuple[int, int]:  # noqa: D102
+        sizes = [
+            cache_file.stat().st_size
+            for cache_file in CACHE_DIR.glob('*.cache')
+        ]
+        return len(sizes), sum(sizes)
+
+
+class SQLiteCacheStorage(CacheStorage):
+    """所有缓存保存在同一个SQLite数据库中，过期时间单独成列并建立索引"""
+
+    def __init__(self, path: Path = CACHE_DB_PATH):  # noqa: D107
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'name TEXT PRIMARY KEY, '
+            'data TEXT NOT NULL, '
+            'expire_at REAL NOT NULL)',
+        )
+        columns = {
+            row[1] for row in self._conn.execute('PRAGMA table_info(cache)')
+        }
+        if 'accessed_at' not in columns:
+            self._conn.execute(
+                'ALTER TABLE cache ADD COLUMN accessed_at REAL NOT NULL '
+                'DEFAULT 0',
+            )
+        if 'size' not in columns:
+            self._conn.execute(
+                'ALTER TABLE cache ADD COLUMN size INTEGER NOT NULL DEFAULT 0',
+            )
+            self._conn.execute('UPDATE cache SET size = length(data)')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS cache_expire_at ON cache (expire_at)',
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS cache_accessed_at '
+            'ON cache (accessed_at)',
+        )
+
+    def get(self, name: str) -> Optional[Tuple[str, float]]:  # noqa: D102
+        entry = self._conn.execute(
+            'SELECT data, expire_at FROM cache WHERE name = ?',
+            (name,),
+        ).fetchone()
+        if entry is not None:
+            self._conn.execute(
+                'UPDATE cache SET accessed_at = ? WHERE name = ?',
+                (time(), name),
+            )
+        return entry
+
+    def set(  # noqa: A003, D102
+        self,
+        name: str,
+        data: str,
+        expire_at: float,
+    ) -> None:
+        self._conn.execute(
+            'INSERT OR REPLACE INTO cache '
+            '(name, data, expire_at, accessed_at, size) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (name, data, expire_at, time(), len(data)),
+        )
+
+    def _delete_selected(self, where: str, params: tuple) -> Tuple[int, int]:
+        with self._conn:
+            self._conn.execute('BEGIN')
+            rows = self._conn.execute(
+                f'SELECT name, size FROM cache {where}',
+                params,
+            ).fetchall()
+            self._conn.executemany(
+                'DELETE FROM cache WHERE name = ?',
+                [(name,) for name, _ in rows],
+            )
+        return len(rows), sum(size for _, size in rows)
+
+    def delete_expired(  # noqa: D102
+        self,
+        before: float,
+        limit: int,
+    ) -> Tuple[int, int]:
+        return self._delete_selected(
+            'WHERE expire_at < ? LIMIT ?',
+            (before, limit),
+        )
+
+    def delete_least_recently_used(  # noqa: D102
+        self,
+        limit: int,
+    ) -> Tuple[int, int]:
+        return self._delete_selected(
+            'ORDER BY accessed_at LIMIT ?',
+            (limit,),
+        )
+
+    def usage(self) -> Tuple[int, int]:  # noqa: D102
+        count, size = self._conn.execute(
+            'SELECT count(*), total(size) FROM cache',
+        ).fetchone()
+        return count, int(size)
+
+    def close(self) -> None:  # noqa: D102
+        self._conn.close()
+
+
+def create_storage() -> CacheStorage:
+    """根据配置创建缓存存储后端"""
+    if config.CACHE_BACKEND == 'sqlite':
+        return SQLiteCacheStorage()
+    if config.CACHE_BACKEND == 'file':
+        return FileCacheStorage()
+    error_msg = f'未知的缓存存储后端{config.CACHE_BACKEND}'
+    raise ValueError(error_msg)
+
+
+def remove_legacy_files(legacy_dir: Path = CACHE_DIR) -> int:
+    """删除旧版每个缓存一个文件的缓存，返回删除的文件数
+
+    旧版缓存的城市信息缺少后来补充的字段，天气信息也会在TTL内过期，
+    不值得导入数据库，直接删除
+    """
+    count = 0
+    for cache_file in legacy_dir.glob('*.cache'):
+        cache_file.unlink(missing_ok=True)
+        count += 1
+    return count
@@ -0,0 +1,72 @@
+from time import time
+from typing import Dict, Tuple, Optional
+
+from .config import config
+from .logger import logger
+from .models import CityInfo
+from .define import CITY_ALIAS_PATH
+from .utils import DelayedSaver, load_json, save_json
+
+# 别名（城市名、拼音、邮政编码、城市id） -> 城市id
+_aliases: Dict[str, str] = {}
+# 城市id -> (城市信息, 更新时间)
+_cities: Dict[str, Tuple[CityInfo, float]] = {}
+
+
+def _load() -> None:
+    data = load_json(CITY_ALIAS_PATH)
+    _aliases.update(data.get('aliases', {}))
+    for city_id, (city, updated_at) in data.get('cities', {}).items():
+        _cities[city_id] = (CityInfo.parse_obj(city), updated_at)
+
+
+def _save() -> None:
+    save_json(
+        CITY_ALIAS_PATH,
+        {
+            'aliases': _aliases,
+            'cities': {
+                city_id: (city.dict(by_alias=True), updated_at)
+                for city_id, (city, updated_at) in _cities.items()
+            },
+        },
+    )
+    logger.debug('已保存城市别名表')
+
+
+_load()
+_saver = DelayedSaver(_save, config.WATCH_LIST_SAVE_DELAY)
+
+
+def normalize_alias(location: str) -> str:
+    """统一别名的写法，忽略首尾空白和大小写"""
+    return location.strip().lower()
+
+
+def get_aliased_city(location: str) -> Optional[CityInfo]:
+    """通过别名获取城市信息，城市信息超过CITY_INFO_TTL时视为不存在"""
+    city_id = _aliases.get(normalize_alias(location))
+    if city_id is None:
+        return None
+    city, updated_at = _cities[city_id]
+    if time() - updated_at >= config.CITY_INFO_TTL:
+        return None
+    return city
+
+
+def get_cached_city(city_id: str) -> Optional[Tuple[CityInfo, float]]:
+    """获取记录过的城市信息和更新时间，不检查是否过期"""
+    return _cities.get(city_id)
+
+
+def add_city_alias(location: str, city: CityInfo) -> None:
+    """记录别名对应的城市，城市id本身也会作为别名记录"""
+    _aliases[normalize_alias(location)] = city.city_id
+    _aliases[city.city_id] = city.city_id
+    _cities[city.city_id] = (city, time())
+    _saver.mark_dirty()
+
+
+def flush_city_alias() -> None:
+    """立即将有修改的别名表写入文件"""
+    _saver.flush()
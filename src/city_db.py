@@ -0,0 +1,254 @@
+from sys import argv
+from array import array
+from pathlib import Path
+from struct import Struct
+from datetime import datetime
+from functools import lru_cache
+from mmap import ACCESS_READ, mmap
+from csv import reader as csv_reader
+from typing import List, Tuple, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from .logger import logger
+from .metrics import metrics
+from .models import CityInfo
+from .define import CITY_DB_PATH
+from .city_alias import normalize_alias
+
+# 文件头：标识、版本、城市数、索引键数
+HEADER = Struct('<4sIII')
+MAGIC = b'HFCD'
+VERSION = 1
+# 和风天气城市列表中使用的列
+COLUMNS = (
+    'Location_ID',
+    'Location_Name_ZH',
+    'Location_Name_EN',
+    'Adm1_Name_ZH',
+    'Adm2_Name_ZH',
+    'Country_Region_ZH',
+    'Timezone',
+    'Latitude',
+    'Longitude',
+)
+# 前缀匹配最多检查的城市数，超过时视为无法确定
+MAX_PREFIX_MATCHES = 32
+
+CITY_DB_LOOKUPS = 'hefeng_city_db_lookups_total'
+metrics.counter(CITY_DB_LOOKUPS, '离线城市数据库查询次数')
+
+
+def build_city_db(csv_path: Path, db_path: Path = CITY_DB_PATH) -> int:
+    """将和风天气发布的城市列表csv转换为离线城市数据库，返回城市数
+
+    数据库由定长的偏移量数组和紧凑的字符串区组成，读取时直接内存映射，
+    索引键为城市id、中文名和拼音，按字节序排序，用二分查找做精确和前缀匹配
+    """
+    rows: List[bytes] = []
+    keys = set()
+    with csv_path.open('r', encoding='utf-8-sig', newline='') as f:
+        lines = csv_reader(f)
+        # 表头之前可能有版本说明行
+        for header in lines:
+            if header and header[0] == 'Location_ID':
+                break
+        else:
+            msg = f'{csv_path}不是和风天气的城市列表'
+            raise ValueError(msg)
+        indexes = [header.index(column) for column in COLUMNS]
+        for line in lines:
+            if len(line) < len(header):
+                continue
+            values = [line[index].strip() for index in indexes]
+            row_no = len(rows)
+            rows.append('\t'.join(values).encode())
+            for alias in values[:3]:
+                if alias:
+                    keys.add((normalize_alias(alias).encode(), row_no))
+    sorted_keys = sorted(keys)
+    row_offsets = array('I', [0])
+    for row in rows:
+        row_offsets.append(row_offsets[-1] + len(row))
+    key_offsets = array('I', [0])
+    for key, _ in sorted_keys:
+        key_offsets.append(key_offsets[-1] + len(key))
+    key_rows = array('I', (row_no for _, row_no in sorted_keys))
+    tmp_path = db_path.with_suffix('.tmp')
+    with tmp_path.open('wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(rows), len(sorted_keys)))
+        f.write(row_offsets.tobytes())
+        f.write(key_offsets.tobytes())
+        f.write(key_rows.tobytes())
+        f.write(b''.join(rows))
+        f.write(b''.join(key for key, _ in sorted_keys))
+    tmp_path.replace(db_path)
+    return len(rows)
+
+
+@lru_cache(maxsize=None)
+def _utc_offset(timezone: str) -> Tuple[str, bool]:
+    """时区当前与UTC的偏移（+08:00格式）和是否处于夏令时"""
+    try:
+        now = datetime.now(ZoneInfo(timezone))
+    except (ValueError, ZoneInfoNotFoundError):
+        return '', False
+    offset = now.strftime('%z')
+    return f'{offset[:3]}:{offset[3:]}', bool(now.dst())
+
+
+class CityDatabase:
+    """内存映射的离线城市数据库"""
+
+    def __init__(self, path: Path):  # noqa: D107
+        with path.open('rb') as f:
+            self._mmap = mmap(f.fileno(), 0, access=ACCESS_READ)
+        magic, version, row_count, key_count = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            msg = f'{path}不是当前版本的离线城市数据库'
+            raise ValueError(msg)
+        view = memoryview(self._mmap)
+        pos = HEADER.size
+        self._row_offsets = view[pos : pos + 4 * (row_count + 1)].cast('I')
+        pos += 4 * (row_count + 1)
+        self._key_offsets = view[pos : pos + 4 * (key_count + 1)].cast('I')
+        pos += 4 * (key_count + 1)
+        self._key_rows = view[pos : pos + 4 * key_count].cast('I')
+        pos += 4 * key_count
+        self._rows = view[pos : pos + self._row_offsets[-1]]
+        pos += self._row_offsets[-1]
+        self._keys = view[pos:]
+        self.row_count = row_count
+        self.key_count = key_count
+
+    def _key(self, index: int) -> bytes:
+        start, end = self._key_offsets[index], self._key_offsets[index + 1]
+        return bytes(self._keys[start:end])
+
+    def _lower_bound(self, key: bytes) -> int:
+        low, high = 0, self.key_count
+        while low < high:
+            mid = (low + high) // 2
+            if self._key(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _city(self, row_no: int) -> CityInfo:
+        start, end = self._row_offsets[row_no], self._row_offsets[row_no + 1]
+        row = bytes(self._rows[start:end]).decode().split('\t')
+        (
+            city_id,
+            name,
+            _,
+            self_adm,
+            superior_adm,
+            country,
+            timezone,
+            latitude,
+            longitude,
+        ) = row
+        utc_offset, is_daylight_saving = _utc_offset(timezone)
+        return CityInfo(
+            name=name,
+            city_id=city_id,
+            latitude=latitude,
+            logtitude=longitude,
+            superior_adm=superior_adm,
+            self_adm=self_adm,
+            country=country,
+            timezone=timezone,
+            utc_offset=utc_offset,
+            is_daylight_saving=is_daylight_saving,
+            city_type='city',
+            rank=0,
+            fix_link='',
+        )
+
+    def search(self, prefix: str, exact: bool = False) -> List[int]:
+        """查找索引键等于或以prefix开头的城市，返回城市序号"""
+        key = normalize_alias(prefix).encode()
+        index = self._lower_bound(key)
+        row_nos = []
+        while index < self.key_count:
+            current = self._key(index)
+            if current != key and (exact or not current.startswith(key)):
+                break
+            row_nos.append(self._key_rows[index])
+            if len(row_nos) > MAX_PREFIX_MATCHES:
+                break
+            index += 1
+        return sorted(set(row_nos))
+
+    def lookup(
+        self,
+        location: str,
+        adm: Optional[str] = None,
+    ) -> Optional[CityInfo]:
+        """查找唯一对应的城市，找不到或无法确定时返回None
+
+        先精确匹配，匹配到多个城市时先按adm筛选上级行政区，
+        再优先选择与上级行政区同名的城市。没有精确匹配时按前缀匹配，
+        前缀匹配只接受唯一的结果（纯数字不做前缀匹配，
+        避免邮政编码被当成城市id的前缀）
+        """
+        row_nos = self.search(location, exact=True)
+        exact = bool(row_nos)
+        if not exact and len(location) >= 2 and not location.isdigit():
+            row_nos = self.search(location)
+        if not row_nos or len(row_nos) > MAX_PREFIX_MATCHES:
+            return None
+        cities = [self._city(row_no) for row_no in row_nos]
+        if adm is not None:
+            cities = [
+                city
+                for city in cities
+                if city.superior_adm.startswith(adm)
+                or city.self_adm.startswith(adm)
+            ]
+        if exact and len(cities) > 1:
+            cities = [
+                city
+                for city in cities
+                if city.name in (city.superior_adm, city.self_adm)
+            ] or cities
+        if exact and len(cities) > 1:
+            cities = [
+                city for city in cities if city.name == city.self_adm
+            ] or cities
+        return cities[0] if len(cities) == 1 else None
+
+
+def _load() -> Optional[CityDatabase]:
+    if not CITY_DB_PATH.exists():
+        return None
+    try:
+        city_db = CityDatabase(CITY_DB_PATH)
+    except (OSError, ValueError) as e:
+        logger.warning(f'离线城市数据库加载失败 {e!r}')
+        return None
+    logger.info(f'已加载离线城市数据库，共{city_db.row_count}个城市')
+    return city_db
+
+
+city_db = _load()
+
+
+def lookup_city(
+    location: str,
+    adm: Optional[str] = None,
+) -> Optional[CityInfo]:
+    """在离线城市数据库中查找城市，没有数据库或无法确定时返回None"""
+    if city_db is None:
+        return None
+    city = city_db.lookup(location, adm)
+    metrics.inc(CITY_DB_LOOKUPS, result='miss' if city is None else 'hit')
+    return city
+
+
+if __name__ == '__main__':
+    if len(argv) != 2:
+        print('用法：python -m src.city_db <城市列表csv路径>')  # noqa: T201
+    else:
+        count = build_city_db(Path(argv[1]))
+        print(f'已生成{CITY_DB_PATH}，共{count}个城市')  # noqa: T201
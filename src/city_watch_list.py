@@ -1,50 +1,149 @@
-from json import dump, load
-from typing import Dict, List, Union, Optional
+from time import time
+from collections import defaultdict
+from typing import Dict, List, Tuple, Union, Optional, DefaultDict
 
+from .config import config
+from .logger import logger
+from .models import CityInfo
 from .define import WATCH_LIST_DIR
+from .utils import DelayedSaver, load_json, save_json
 from .exceptions import CityInWatchListError, CityNotInWatchListError
 
 GROUP_WATCH_LIST_PATH = WATCH_LIST_DIR / 'group_watch_list.json'
 SELF_WATCH_LIST_PATH = WATCH_LIST_DIR / 'self_watch_list.json'
+CITY_SNAPSHOT_PATH = WATCH_LIST_DIR / 'city_snapshot.json'
 GROUP_WATCH_LIST = Dict[int, List[str]]  # 群号，城市id列表
 SELF_WATCH_LIST = Dict[int, str]  # qid，城市id
 
 
+# 内存中的关注列表为唯一数据源，修改后延迟批量写入文件
+_group_watch_list: GROUP_WATCH_LIST = load_json(GROUP_WATCH_LIST_PATH)
+_self_watch_list: SELF_WATCH_LIST = load_json(SELF_WATCH_LIST_PATH)
+# 城市id -> (关注时解析的城市信息, 更新时间)
+_city_snapshots: Dict[str, Tuple[CityInfo, float]] = {
+    city_id: (CityInfo.parse_obj(city), updated_at)
+    for city_id, (city, updated_at) in load_json(CITY_SNAPSHOT_PATH).items()
+}
+# 城市id -> 关注该城市的群号
+_city_groups: DefaultDict[str, List[str]] = defaultdict(list)
+for _group_id, _city_list in _group_watch_list.items():
+    for _city_id in _city_list:
+        _city_groups[_city_id].append(_group_id)
+
+
+def _save_group_watch_list() -> None:
+    save_json(GROUP_WATCH_LIST_PATH, _group_watch_list)
+    logger.debug('已保存群关注列表')
+
+
+def _save_self_watch_list() -> None:
+    save_json(SELF_WATCH_LIST_PATH, _self_watch_list)
+    logger.debug('已保存个人关注列表')
+
+
+_group_saver = DelayedSaver(
+    _save_group_watch_list,
+    config.WATCH_LIST_SAVE_DELAY,
+)
+_self_saver = DelayedSaver(_save_self_watch_list, config.WATCH_LIST_SAVE_DELAY)
+
+
+def _save_city_snapshot() -> None:
+    save_json(
+        CITY_SNAPSHOT_PATH,
+        {
+            city_id: (city.dict(by_alias=True), updated_at)
+            for city_id, (city, updated_at) in _city_snapshots.items()
+        },
+    )
+    logger.debug('已保存关注城市信息')
+
+
+_snapshot_saver = DelayedSaver(
+    _save_city_snapshot,
+    config.WATCH_LIST_SAVE_DELAY,
+)
+
+
+def flush_watch_list() -> None:
+    """立即将有修改的关注列表写入文件"""
+    _group_saver.flush()
+    _self_saver.flush()
+    _snapshot_saver.flush()
+
+
+def _is_watched(city_id: str) -> bool:
+    return city_id in _city_groups or city_id in _self_watch_list.values()
+
+
+def get_city_snapshot(city_id: str) -> Optional[Tuple[CityInfo, float]]:
+    """获取关注城市保存的城市信息和更新时间，不检查是否过期"""
+    return _city_snapshots.get(city_id)
+
+
+def update_city_snapshot(city: CityInfo) -> None:
+    """更新关注城市保存的城市信息，未被关注的城市不保存"""
+    if _is_watched(city.city_id):
+        _city_snapshots[city.city_id] = (city, time())
+        _snapshot_saver.mark_dirty()
+
+
+def _drop_city_snapshot(city_id: str) -> None:
+    if city_id in _city_snapshots and not _is_watched(city_id):
+        del _city_snapshots[city_id]
+        _snapshot_saver.mark_dirty()
+
+
+def _schedule_save(group: bool) -> None:
+    (_group_saver if group else _self_saver).mark_dirty()
+
+
 def get_watch_list(
     group: bool = True,
 ) -> Optional[Union[GROUP_WATCH_LIST, SELF_WATCH_LIST]]:
     """获取关注列表"""
-    watch_list_path = GROUP_WATCH_LIST_PATH if group else SELF_WATCH_LIST_PATH
-    if watch_list_path.exists():
-        with watch_list_path.open('r', encoding='utf-8') as f:
-            return load(f)
-    return None
+    watch_list = _group_watch_list if group else _self_watch_list
+    if not watch_list:
+        return None
+    return {
+        target_id: list(value) if group else value
+        for target_id, value in watch_list.items()
+    }
+
+
+def get_watched_city_ids() -> List[str]:
+    """获取所有群关注的城市id，每个城市只出现一次"""
+    return list(_city_groups)
+
+
+def get_city_groups(city_id: str) -> List[str]:
+    """获取关注某城市的所有群号"""
+    return list(_city_groups.get(city_id, ()))
 
 
 def add_watch_list(
     target_id: Union[int, str],
-    city_id: str,
+    city: CityInfo,
     group: bool = True,
 ) -> None:
-    """添加关注"""
+    """添加关注，同时保存城市信息"""
     target_id = str(target_id)
-    watch_list = get_watch_list(group)
-    if watch_list is None:
-        watch_list = {}
-    if target_id not in watch_list:
-        watch_list[target_id] = [city_id] if group else city_id
+    city_id = city.city_id
+    if group:
+        city_list = _group_watch_list.setdefault(target_id, [])
+        if city_id in city_list:
+            raise CityInWatchListError
+        city_list.append(city_id)
+        _city_groups[city_id].append(target_id)
     else:
-        if group:
-            if city_id in watch_list[target_id]:
-                raise CityInWatchListError
-            watch_list[target_id].append(city_id)
-        else:
-            if watch_list[target_id] == city_id:
-                raise CityInWatchListError
-            watch_list[target_id] = city_id
-    watch_list_path = GROUP_WATCH_LIST_PATH if group else SELF_WATCH_LIST_PATH
-    with watch_list_path.open('w', encoding='utf-8') as f:
-        dump(watch_list, f)
+        if _self_watch_list.get(target_id) == city_id:
+            raise CityInWatchListError
+        previous = _self_watch_list.get(target_id)
+        _self_watch_list[target_id] = city_id
+        if previous:
+            _drop_city_snapshot(previous)
+    update_city_snapshot(city)
+    _schedule_save(group)
 
 
 def remove_watch_list(
@@ -54,22 +153,20 @@ def remove_watch_list(
 ) -> None:
     """移除关注"""
     target_id = str(target_id)
-    watch_list = get_watch_list(group)
-    if watch_list is None:
-        watch_list = {}
-    if target_id not in watch_list:
-        raise CityNotInWatchListError
     if group:
-        if city_id not in watch_list[target_id]:
+        city_list = _group_watch_list.get(target_id)
+        if city_list is None or city_id not in city_list:
             raise CityNotInWatchListError
-        watch_list[target_id].remove(city_id)
+        city_list.remove(city_id)
+        _city_groups[city_id].remove(target_id)
+        if not _city_groups[city_id]:
+            del _city_groups[city_id]
     else:
-        if watch_list[target_id] != city_id:
+        if _self_watch_list.get(target_id) != city_id:
             raise CityNotInWatchListError
-        watch_list[target_id] = ''
-    watch_list_path = GROUP_WATCH_LIST_PATH if group else SELF_WATCH_LIST_PATH
-    with watch_list_path.open('w', encoding='utf-8') as f:
-        dump(watch_list, f)
+        _self_watch_list[target_id] = ''
+    _drop_city_snapshot(city_id)
+    _schedule_save(group)
 
 
 def get_watched_city(
@@ -78,9 +175,7 @@ def get_watched_city(
 ) -> Optional[Union[List[str], str]]:
     """获取关注的城市"""
     target_id = str(target_id)
-    watch_list = get_watch_list(group)
-    if watch_list is None:
-        return None
+    watch_list = _group_watch_list if group else _self_watch_list
     if target_id not in watch_list:
         return None
-    return watch_list[target_id]
+    return list(watch_list[target_id]) if group else watch_list[target_id]
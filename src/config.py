@@ -1,3 +1,4 @@
+from typing import List
 from pathlib import Path
 
 from pydantic import BaseModel
@@ -15,7 +16,40 @@ class Config(BaseModel):
     FREE_SUBSCRIBE: bool = True
     CITY_INFO_TTL: int = 86400
     WEATHER_INFO_TTL: int = 600
+    WEATHER_INFO_MAX_STALE: int = 1800
+    DAILY_WEATHER_UPDATE_HOURS: List[int] = [5, 8, 11, 18, 20]
+    DAILY_WEATHER_UPDATE_DELAY: int = 20
+    COORDINATE_QUANTIZATION: str = 'grid'
+    COORDINATE_GRID_PRECISION: int = 2
+    COORDINATE_GEOHASH_PRECISION: int = 6
     SEND_MESSAGE_INTERVAL: float = 0
+    SEND_MAX_CONCURRENCY: int = 4
+    SCHEDULED_JOB_CONCURRENCY: int = 8
+    FORECAST_AIR_QUALITY: bool = False
+    WEATHER_ALERT_INTERVAL: int = 0
+    NOWCAST_INTERVAL: int = 0
+    WATCH_LIST_SAVE_DELAY: float = 5
+    RATE_LIMIT_PER_MINUTE: int = 300
+    MAX_CONCURRENT_REQUESTS: int = 10
+    REQUEST_MAX_RETRIES: int = 3
+    RETRY_BASE_DELAY: float = 0.5
+    RETRY_MAX_DELAY: float = 8
+    DAILY_QUOTA: int = 1000
+    DAILY_QUOTA_WARN_RATIO: float = 0.8
+    METRICS_EXPORT_INTERVAL: int = 60
+    CONNECTION_POOL_LIMIT: int = 100
+    CONNECTION_POOL_LIMIT_PER_HOST: int = 10
+    DNS_CACHE_TTL: int = 300
+    KEEPALIVE_TIMEOUT: float = 30
+    REQUEST_TIMEOUT: float = 10
+    CACHE_BACKEND: str = 'sqlite'
+    CACHE_MAX_ENTRIES: int = 100000
+    CACHE_MAX_SIZE: int = 268435456
+    CACHE_SWEEP_INTERVAL: int = 3600
+    CACHE_SWEEP_BATCH_SIZE: int = 500
+    MEMORY_CACHE_MAX_ENTRIES: int = 2048
+    MEMORY_CACHE_MAX_SIZE: int = 16777216
+    RENDER_CACHE_MAX_ENTRIES: int = 1024
 
     @classmethod
     def load(cls) -> 'Config':
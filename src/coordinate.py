@@ -0,0 +1,105 @@
+import re
+from typing import Dict, Tuple
+from collections import Counter
+
+from .config import config
+from .metrics import metrics
+
+COORDINATE_PATTERN = re.compile(
+    r'^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$',
+)
+# 和风天气的经纬度最多支持两位小数
+MAX_DECIMALS = 2
+_GEOHASH_BITS = 5
+
+# (函数名, 量化方式和精度) -> 查询次数/命中缓存次数
+coordinate_lookups: Counter = Counter()
+coordinate_hits: Counter = Counter()
+
+
+def _geohash_cell_center(
+    longitude: float,
+    latitude: float,
+    precision: int,
+) -> Tuple[float, float]:
+    """计算坐标所在的指定长度geohash格子的中心点"""
+    lon_range = [-180.0, 180.0]
+    lat_range = [-90.0, 90.0]
+    for bit in range(precision * _GEOHASH_BITS):
+        # geohash从经度开始交替二分
+        value, value_range = (
+            (longitude, lon_range) if bit % 2 == 0 else (latitude, lat_range)
+        )
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+    return sum(lon_range) / 2, sum(lat_range) / 2
+
+
+def quantization_level() -> str:
+    """当前的量化方式和精度，用于统计"""
+    if config.COORDINATE_QUANTIZATION == 'geohash':
+        return f'geohash:{config.COORDINATE_GEOHASH_PRECISION}'
+    if config.COORDINATE_QUANTIZATION == 'grid':
+        return f'grid:{config.COORDINATE_GRID_PRECISION}'
+    return 'none'
+
+
+def quantize_coordinate(longitude: float, latitude: float) -> str:
+    """将经纬度量化到所在格子的中心，使相近的坐标共用同一个查询
+
+    :return: 和风天气api使用的'经度,纬度'格式
+    """
+    if config.COORDINATE_QUANTIZATION == 'geohash':
+        longitude, latitude = _geohash_cell_center(
+            longitude,
+            latitude,
+            config.COORDINATE_GEOHASH_PRECISION,
+        )
+        decimals = MAX_DECIMALS
+    elif config.COORDINATE_QUANTIZATION == 'grid':
+        decimals = min(config.COORDINATE_GRID_PRECISION, MAX_DECIMALS)
+    else:
+        decimals = MAX_DECIMALS
+    # 加0.0避免出现-0
+    longitude = round(longitude, decimals) + 0.0
+    latitude = round(latitude, decimals) + 0.0
+    return f'{longitude:g},{latitude:g}'
+
+
+def quantize_location(location: str) -> str:
+    """location为经纬度时进行量化，否则原样返回"""
+    match = COORDINATE_PATTERN.match(location)
+    if match is None:
+        return location
+    longitude, latitude = map(float, match.groups())
+    return quantize_coordinate(longitude, latitude)
+
+
+def record_lookup(func_name: str, hit: bool) -> None:
+    """记录一次经纬度查询是否命中缓存"""
+    key = func_name, quantization_level()
+    coordinate_lookups[key] += 1
+    if hit:
+        coordinate_hits[key] += 1
+
+
+def get_hit_rates() -> Dict[Tuple[str, str], float]:
+    """各函数在各量化方式和精度下经纬度查询的缓存命中率"""
+    return {
+        key: coordinate_hits[key] / count
+        for key, count in coordinate_lookups.items()
+    }
+
+
+metrics.collector(
+    'hefeng_coordinate_cache_hit_ratio',
+    'gauge',
+    '各函数在各量化精度下经纬度查询的缓存命中率',
+    lambda: [
+        ({'function': func_name, 'level': level}, rate)
+        for (func_name, level), rate in get_hit_rates().items()
+    ],
+)
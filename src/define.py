@@ -2,6 +2,11 @@ from pathlib import Path
 
 DATA_DIR = Path(__file__).resolve().parent.parent / 'data'
 CACHE_DIR = DATA_DIR / 'cache'
+CACHE_DB_PATH = DATA_DIR / 'cache.sqlite3'
 WATCH_LIST_DIR = DATA_DIR / 'watch_list'
+CITY_ALIAS_PATH = DATA_DIR / 'city_alias.json'
+CITY_DB_PATH = DATA_DIR / 'city_db.bin'
+METRICS_PATH = DATA_DIR / 'metrics.prom'
+WEATHER_ALERT_PATH = DATA_DIR / 'weather_alert.json'
 CACHE_DIR.mkdir(exist_ok=True, parents=True)
 WATCH_LIST_DIR.mkdir(exist_ok=True, parents=True)
@@ -0,0 +1,171 @@
+from typing import Dict, List, Tuple, Callable
+
+from .define import METRICS_PATH
+
+Labels = Tuple[Tuple[str, str], ...]
+Collector = Callable[[], List[Tuple[Dict[str, str], float]]]
+
+# 默认的延迟分桶，单位为s
+DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """累计分桶的直方图"""
+
+    def __init__(self, buckets: Tuple[float, ...]):  # noqa: D107
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """记录一个观测值"""
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    content = ','.join(f'{k}="{v}"' for k, v in labels)
+    return f'{{{content}}}'
+
+
+class MetricsRegistry:
+    """轻量的指标注册表
+
+    计数器和直方图在热路径上直接更新，
+    已有统计数据的模块通过collector在导出时提供当前值
+    """
+
+    def __init__(self):  # noqa: D107
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+        self._collectors: Dict[str, Collector] = {}
+
+    def counter(self, name: str, help_text: str) -> None:
+        """声明计数器"""
+        self._help[name] = ('counter', help_text)
+        self._counters.setdefault(name, {})
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        """声明直方图"""
+        self._help[name] = ('histogram', help_text)
+        self._histograms.setdefault(name, {})
+        self._buckets[name] = buckets
+
+    def collector(
+        self,
+        name: str,
+        metric_type: str,
+        help_text: str,
+        collect: Collector,
+    ) -> None:
+        """声明由collect函数在导出时提供值的指标"""
+        self._help[name] = (metric_type, help_text)
+        self._collectors[name] = collect
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        """计数器加value"""
+        key = tuple(sorted(labels.items()))
+        series = self._counters[name]
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """直方图记录一个观测值"""
+        key = tuple(sorted(labels.items()))
+        series = self._histograms[name]
+        if key not in series:
+            series[key] = Histogram(self._buckets[name])
+        series[key].observe(value)
+
+    def _samples(self) -> Dict[str, List[Tuple[str, Labels, float]]]:
+        """所有指标的样本，按指标名分组，样本为(后缀, 标签, 值)"""
+        samples: Dict[str, List[Tuple[str, Labels, float]]] = {}
+        for name, series in self._counters.items():
+            samples[name] = [('', labels, v) for labels, v in series.items()]
+        for name, series in self._histograms.items():
+            samples[name] = []
+            for labels, histogram in series.items():
+                for bound, count in zip(
+                    histogram.buckets,
+                    histogram.bucket_counts,
+                ):
+                    samples[name].append(
+                        ('_bucket', (*labels, ('le', f'{bound:g}')), count),
+                    )
+                samples[name].extend(
+                    [
+                        (
+                            '_bucket',
+                            (*labels, ('le', '+Inf')),
+                            histogram.count,
+                        ),
+                        ('_sum', labels, histogram.sum),
+                        ('_count', labels, histogram.count),
+                    ],
+                )
+        for name, collect in self._collectors.items():
+            samples[name] = [
+                ('', tuple(sorted(labels.items())), value)
+                for labels, value in collect()
+            ]
+        return samples
+
+    def render_prometheus(self) -> str:
+        """导出为Prometheus文本格式"""
+        lines = []
+        for name, name_samples in self._samples().items():
+            metric_type, help_text = self._help[name]
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            lines.extend(
+                f'{name}{suffix}{_format_labels(labels)} {value:g}'
+                for suffix, labels, value in name_samples
+            )
+        return '\n'.join(lines) + '\n'
+
+    def render_summary(self) -> str:
+        """导出为便于阅读的摘要，直方图只显示次数和平均值"""
+        lines = []
+        for name, name_samples in self._samples().items():
+            if not name_samples:
+                continue
+            lines.append(f'{self._help[name][1]}：')
+            if name in self._histograms:
+                for labels, histogram in self._histograms[name].items():
+                    average = histogram.sum / histogram.count
+                    lines.append(
+                        f'  {_format_labels(labels)} '
+                        f'{histogram.count}次 平均{average:.3f}s',
+                    )
+                continue
+            for _, labels, value in name_samples:
+                label_text = _format_labels(labels)
+                lines.append(
+                    (
+                        f'  {label_text} {value:g}'
+                        if label_text
+                        else f'  {value:g}'
+                    ),
+                )
+        return '\n'.join(lines)
+
+    def write_file(self) -> None:
+        """先写入临时文件再重命名，供node_exporter的textfile collector读取"""
+        tmp_path = METRICS_PATH.with_suffix('.tmp')
+        tmp_path.write_text(self.render_prometheus(), encoding='utf-8')
+        tmp_path.replace(METRICS_PATH)
+
+
+metrics = MetricsRegistry()
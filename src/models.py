@@ -1,7 +1,8 @@
-from datetime import datetime
-from typing import Literal, Optional
+from datetime import time, datetime
+from datetime import date as date_type
+from typing import List, Literal, Optional
 
-from pydantic import Field, BaseModel
+from pydantic import Field, BaseModel, validator
 
 
 class ConfigedBaseModel(BaseModel):
@@ -82,23 +83,23 @@ class CityWeatherApi:
     class DailyWeather(ConfigedBaseModel):
         """每日天气"""
 
-        date: datetime = Field(alias='fxDate', description='预报日期')
-        sunrise: Optional[datetime] = Field(
+        date: date_type = Field(alias='fxDate', description='预报日期')
+        sunrise: Optional[time] = Field(
             default=None,
             alias='sunrise',
             description='日出时间，在高纬度地区可能为空',
         )
-        sunset: Optional[datetime] = Field(
+        sunset: Optional[time] = Field(
             default=None,
             alias='sunset',
             description='日落时间，在高纬度地区可能为空',
         )
-        moonrise: Optional[datetime] = Field(
+        moonrise: Optional[time] = Field(
             default=None,
             alias='moonrise',
             description='当天月升时间，可能为空',
         )
-        moonset: Optional[datetime] = Field(
+        moonset: Optional[time] = Field(
             default=None,
             alias='moonset',
             description='当天月落时间，可能为空',
@@ -187,6 +188,12 @@ class CityWeatherApi:
             description='云量，百分比数值。可能为空',
         )
 
+        @validator('sunrise', 'sunset', 'moonrise', 'moonset', pre=True)
+        @classmethod
+        def empty_to_none(cls, value):  # noqa: D102
+            # 接口中为空的字段是空字符串
+            return value or None
+
     class HourlyWeather(ConfigedBaseModel):
         """小时天气"""
 
@@ -465,6 +472,19 @@ class AirQuality:
         co: str = Field(description='一氧化碳')
         o3: str = Field(description='臭氧')
 
+    class AirQualityInfo(ConfigedBaseModel):
+        """城市空气质量和周边监测站数据，对应一次接口返回"""
+
+        now: 'AirQuality.AirQualityNow' = Field(description='当前空气质量')
+        stations: List['AirQuality.AirQualityStation'] = Field(
+            default_factory=list,
+            alias='station',
+            description='监测站数据，部分城市可能为空',
+        )
+
+
+AirQuality.AirQualityInfo.update_forward_refs(AirQuality=AirQuality)
+
 
 class WeatherAlert(ConfigedBaseModel):
     """天气预警"""
@@ -472,21 +492,58 @@ class WeatherAlert(ConfigedBaseModel):
     id: str = Field(  # noqa: A003
         description='本条预警的唯一标识，可判断本条预警是否已经存在',
     )
-    sender: str = Field(description='预警发布单位，可能为空')
-    publish_time: datetime = Field(description='预警发布时间')
+    sender: Optional[str] = Field(
+        default=None,
+        description='预警发布单位，可能为空',
+    )
+    publish_time: datetime = Field(alias='pubTime', description='预警发布时间')
     title: str = Field(description='预警信息标题')
-    start_time: datetime = Field(description='预警开始时间，可能为空')
-    end_time: datetime = Field(description='预警结束时间，可能为空')
+    start_time: Optional[datetime] = Field(
+        default=None,
+        alias='startTime',
+        description='预警开始时间，可能为空',
+    )
+    end_time: Optional[datetime] = Field(
+        default=None,
+        alias='endTime',
+        description='预警结束时间，可能为空',
+    )
     status: str = Field(description='预警信息的发布状态')
     severity: str = Field(description='预警严重等级')
-    severity_color: str = Field(description='预警严重等级颜色，可能为空')
+    severity_color: Optional[str] = Field(
+        default=None,
+        alias='severityColor',
+        description='预警严重等级颜色，可能为空',
+    )
     type: str = Field(description='预警类型ID')  # noqa: A003
-    type_name: str = Field(description='预警类型名称')
-    urgency: str = Field(description='预警信息的紧迫程度，可能为空')
-    certainty: str = Field(description='预警信息的确定性，可能为空')
+    type_name: str = Field(alias='typeName', description='预警类型名称')
+    urgency: Optional[str] = Field(
+        default=None,
+        description='预警信息的紧迫程度，可能为空',
+    )
+    certainty: Optional[str] = Field(
+        default=None,
+        description='预警信息的确定性，可能为空',
+    )
     text: str = Field(description='预警详细文字描述')
-    related: str = Field(
+    related: Optional[str] = Field(
+        default=None,
         description=(
             '与本条预警相关联的预警ID，当预警状态为cancel或update时返回。可能为空'
         ),
     )
+
+    @validator(
+        'sender',
+        'start_time',
+        'end_time',
+        'severity_color',
+        'urgency',
+        'certainty',
+        'related',
+        pre=True,
+    )
+    @classmethod
+    def empty_to_none(cls, value):  # noqa: D102
+        # 接口中为空的字段是空字符串
+        return value or None
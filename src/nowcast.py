@@ -0,0 +1,44 @@
+from datetime import timedelta
+from typing import Dict, List, Iterable, Optional
+
+from .models import MinutePrecipitation
+
+# 判断是否降水的时间范围
+NOWCAST_WINDOW = timedelta(hours=1)
+
+# 城市id -> 上次推送时未来一小时内是否有降水
+_raining: Dict[str, bool] = {}
+
+
+def upcoming_precipitation(
+    minutely: List[MinutePrecipitation],
+) -> Optional[MinutePrecipitation]:
+    """未来一小时内第一个有降水的时段，没有降水时返回None"""
+    if not minutely:
+        return None
+    end_time = minutely[0].time + NOWCAST_WINDOW
+    for item in minutely:
+        if item.time >= end_time:
+            break
+        if item.precipitation > 0:
+            return item
+    return None
+
+
+def update_rain_state(city_id: str, raining: bool) -> bool:
+    """记录城市的降水状态，返回是否发生了开始或停止降水的变化
+
+    城市第一次记录时只作为基准，不视为变化
+    """
+    last = _raining.get(city_id)
+    _raining[city_id] = raining
+    return last is not None and last != raining
+
+
+def prune_rain_state(city_ids: Iterable[str]) -> None:
+    """移除已经没有群关注的城市"""
+    city_ids = set(city_ids)
+    for city_id in [
+        city_id for city_id in _raining if city_id not in city_ids
+    ]:
+        del _raining[city_id]
@@ -0,0 +1,130 @@
+from datetime import date
+from time import monotonic
+from asyncio import Lock, Condition, sleep
+
+from .config import config
+from .logger import logger
+from .metrics import metrics
+
+
+class RateLimiter:
+    """所有api共用的限流器
+
+    - 令牌桶限制每分钟请求数
+    - 自适应并发数，被限流时减半，连续成功后逐步恢复
+    - 每日调用次数计数，接近配额时发出警告
+    """
+
+    def __init__(  # noqa: D107
+        self,
+        per_minute: int,
+        max_concurrency: int,
+        daily_quota: int,
+        quota_warn_ratio: float,
+    ):
+        self._rate = per_minute / 60
+        # 最多允许约10秒的突发请求
+        self._capacity = max(1, per_minute // 6)
+        self._tokens = float(self._capacity)
+        self._updated = monotonic()
+        self._token_lock = Lock()
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self._active = 0
+        self._successes = 0
+        self._condition = Condition()
+        self.daily_quota = daily_quota
+        self._quota_warn_count = daily_quota * quota_warn_ratio
+        self._quota_date = date.today()
+        self.daily_count = 0
+        self._quota_warned = False
+
+    async def _acquire_token(self) -> None:
+        async with self._token_lock:
+            while True:
+                now = monotonic()
+                self._tokens = min(
+                    self._capacity,
+                    self._tokens + (now - self._updated) * self._rate,
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await sleep((1 - self._tokens) / self._rate)
+
+    def _count_quota(self) -> None:
+        today = date.today()
+        if today != self._quota_date:
+            self._quota_date = today
+            self.daily_count = 0
+            self._quota_warned = False
+        self.daily_count += 1
+        if (
+            self.daily_quota
+            and not self._quota_warned
+            and self.daily_count >= self._quota_warn_count
+        ):
+            self._quota_warned = True
+            logger.warning(
+                f'今日已调用api{self.daily_count}次，'
+                f'接近每日{self.daily_quota}次的配额',
+            )
+
+    async def _release(self) -> None:
+        async with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    async def __aenter__(self) -> None:  # noqa: D105
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self._active < self.concurrency,
+            )
+            self._active += 1
+        try:
+            await self._acquire_token()
+        except BaseException:
+            await self._release()
+            raise
+        self._count_quota()
+
+    async def __aexit__(self, *_) -> None:  # noqa: D105
+        await self._release()
+
+    def on_success(self) -> None:
+        """请求成功，连续成功次数达到当前并发数时并发数加一"""
+        self._successes += 1
+        if (
+            self._successes >= self.concurrency
+            and self.concurrency < self.max_concurrency
+        ):
+            self.concurrency += 1
+            self._successes = 0
+
+    def on_throttled(self) -> None:
+        """请求被限流，并发数减半"""
+        self._successes = 0
+        if self.concurrency > 1:
+            self.concurrency = max(1, self.concurrency // 2)
+            logger.warning(f'api请求被限流，并发数降低为{self.concurrency}')
+
+
+rate_limiter = RateLimiter(
+    config.RATE_LIMIT_PER_MINUTE,
+    config.MAX_CONCURRENT_REQUESTS,
+    config.DAILY_QUOTA,
+    config.DAILY_QUOTA_WARN_RATIO,
+)
+metrics.collector(
+    'hefeng_api_daily_calls',
+    'gauge',
+    '今日api调用次数',
+    lambda: [({}, rate_limiter.daily_count)],
+)
+metrics.collector(
+    'hefeng_api_concurrency',
+    'gauge',
+    '当前允许的api并发请求数',
+    lambda: [({}, rate_limiter.concurrency)],
+)
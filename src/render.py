@@ -0,0 +1,297 @@
+from string import Formatter
+from operator import attrgetter
+from collections import OrderedDict
+from typing import Any, List, Tuple, Callable, Hashable, Optional
+
+from .config import config
+from .api_cache import memory_cache
+from .series import HourlyWeatherSeries
+from .models import (
+    AirQuality,
+    WeatherAlert,
+    CityWeatherApi,
+    BlockWeatherApi,
+    MinutePrecipitation,
+)
+
+
+class Template:
+    """预先解析的消息模板
+
+    模板语法与str.format相同，字段写作'{参数名.属性名:格式}'，
+    解析结果只在创建时生成一次，渲染时只做取值和格式化
+    """
+
+    def __init__(self, template: str):  # noqa: D107
+        self._parts: List[Tuple[str, Optional[str], Callable, str]] = []
+        for literal, field, spec, _ in Formatter().parse(template):
+            if field is None:
+                self._parts.append((literal, None, str, ''))
+                continue
+            name, _, attrs = field.partition('.')
+            getter = attrgetter(attrs) if attrs else (lambda value: value)
+            self._parts.append((literal, name, getter, spec))
+
+    def __call__(self, **kwargs: Any) -> str:  # noqa: D102
+        return ''.join(
+            (
+                literal
+                if name is None
+                else literal + format(getter(kwargs[name]), spec)
+            )
+            for literal, name, getter, spec in self._parts
+        )
+
+
+NOW_WEATHER = Template(
+    '{name}的天气：\n'
+    '{weather.weather_description}\n'
+    '气温{weather.temperature}℃\n'
+    '体感温度{weather.feels_temperature}℃\n'
+    '湿度{weather.humidity}%\n'
+    '云量{weather.cloud_amount}%',
+)
+# 格点天气没有体感温度
+GRID_NOW_WEATHER = Template(
+    '{name}的天气：\n'
+    '{weather.weather_description}\n'
+    '气温{weather.temperature}℃\n'
+    '湿度{weather.humidity}%\n'
+    '云量{weather.cloud_amount}%',
+)
+HOURLY_WEATHER_LINE = Template(
+    '-> {hour.time:%H:%M} '
+    '{hour.weather_description} '
+    '{hour.temperature}℃ '
+    '湿度{hour.humidity}% '
+    '云量{hour.cloud_amount}% '
+    '降水概率{hour.precipitation_probability}%',
+)
+DAILY_WEATHER_LINE = Template(
+    '-> {day.date:%m-%d} '
+    '{day.weather_description_day}/{day.weather_description_night} '
+    '{day.temperature_min}~{day.temperature_max}℃ '
+    '湿度{day.humidity}% '
+    '降水{day.precipitation}mm '
+    '紫外线{day.uv_index}',
+)
+AIR_QUALITY = Template(
+    '{name}的空气质量：\n'
+    'AQI {now.aqi}（{now.category}）\n'
+    '主要污染物 {now.primary}\n'
+    'PM2.5 {now.pm2p5} PM10 {now.pm10}\n'
+    'NO2 {now.no2} SO2 {now.so2} CO {now.co} O3 {now.o3}',
+)
+AIR_QUALITY_STATION_LINE = Template(
+    '-> {station.name} AQI {station.aqi}（{station.category}）',
+)
+AIR_QUALITY_BRIEF = Template('空气质量：AQI {now.aqi}（{now.category}）')
+RAIN_ONSET = Template(
+    '{name}预计{precipitation.time:%H:%M}开始{kind}'
+    '，5分钟降水量{precipitation.precipitation}mm',
+)
+RAIN_STOP = Template('{name}的降水已停止，未来1小时内无降水')
+WEATHER_ALERT = Template('{name}[{change}] {alert.title}\n{alert.text}')
+HOURLY_PRECIPITATION_LINE = Template(
+    '-> {hour.time:%H:%M} '
+    '{hour.weather_description} '
+    '降水概率{hour.precipitation_probability}%',
+)
+
+
+class FragmentCache:
+    """渲染结果缓存
+
+    条目保存渲染所用数据在内存缓存中的版本号，版本号变化（缓存已刷新）时重新渲染，
+    因此同一份数据只会渲染一次。只保存版本号而不持有数据对象，
+    数据被内存缓存淘汰后即可释放；不在内存缓存中的数据不缓存渲染结果
+    """
+
+    def __init__(self, max_entries: int):  # noqa: D107
+        self.max_entries = max_entries
+        self._data: OrderedDict[Hashable, Tuple[int, str]] = OrderedDict()
+
+    def get_or_render(
+        self,
+        key: Hashable,
+        data: Any,
+        render: Callable[[], str],
+    ) -> str:
+        """获取key对应的渲染结果，数据已更新时重新渲染"""
+        version = memory_cache.version(data)
+        if version is None:
+            return render()
+        entry = self._data.get(key)
+        if entry is not None and entry[0] == version:
+            self._data.move_to_end(key)
+            return entry[1]
+        text = render()
+        self._data[key] = (version, text)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+        return text
+
+
+fragment_cache = FragmentCache(config.RENDER_CACHE_MAX_ENTRIES)
+
+
+def render_now_weather(
+    city_id: str,
+    name: str,
+    weather: CityWeatherApi.NowWeather,
+) -> str:
+    """当前天气"""
+    return fragment_cache.get_or_render(
+        (city_id, 'now_weather', name),
+        weather,
+        lambda: NOW_WEATHER(name=name, weather=weather),
+    )
+
+
+def render_grid_now_weather(
+    coordinate: str,
+    name: str,
+    weather: BlockWeatherApi.NowWeather,
+) -> str:
+    """经纬度的当前格点天气"""
+    return fragment_cache.get_or_render(
+        (coordinate, 'grid_now_weather', name),
+        weather,
+        lambda: GRID_NOW_WEATHER(name=name, weather=weather),
+    )
+
+
+def _render_hourly(
+    title: str,
+    line: Template,
+    series: HourlyWeatherSeries,
+) -> str:
+    return '\n'.join([title, *(line(hour=hour) for hour in series)])
+
+
+def render_hourly_weather(
+    city_id: str,
+    name: str,
+    series: HourlyWeatherSeries,
+) -> str:
+    """未来24小时天气"""
+    return fragment_cache.get_or_render(
+        (city_id, 'hourly_weather', name),
+        series,
+        lambda: _render_hourly(
+            f'{name}的未来24h天气：',
+            HOURLY_WEATHER_LINE,
+            series,
+        ),
+    )
+
+
+def render_hourly_precipitation(
+    city_id: str,
+    name: str,
+    series: HourlyWeatherSeries,
+) -> str:
+    """未来24小时降雨"""
+    return fragment_cache.get_or_render(
+        (city_id, 'hourly_precipitation', name),
+        series,
+        lambda: _render_hourly(
+            f'{name}的未来24h降雨：',
+            HOURLY_PRECIPITATION_LINE,
+            series,
+        ),
+    )
+
+
+def render_forecast(
+    city_id: str,
+    name: str,
+    series: HourlyWeatherSeries,
+) -> str:
+    """定时推送中单个城市的未来6小时天气"""
+    return fragment_cache.get_or_render(
+        (city_id, 'forecast', name),
+        series,
+        lambda: _render_hourly(
+            f'{name}的未来6h降雨：',
+            HOURLY_WEATHER_LINE,
+            series[:6],
+        ),
+    )
+
+
+def render_daily_weather(
+    city_id: str,
+    name: str,
+    days: str,
+    daily: List[CityWeatherApi.DailyWeather],
+) -> str:
+    """每日天气"""
+    return fragment_cache.get_or_render(
+        (city_id, 'daily_weather', name, days),
+        daily,
+        lambda: '\n'.join(
+            [
+                f'{name}的未来{len(daily)}天天气：',
+                *(DAILY_WEATHER_LINE(day=day) for day in daily),
+            ],
+        ),
+    )
+
+
+def render_air_quality(
+    city_id: str,
+    name: str,
+    air_quality: AirQuality.AirQualityInfo,
+) -> str:
+    """城市空气质量及各监测站数据"""
+
+    def render() -> str:
+        msg_list = [AIR_QUALITY(name=name, now=air_quality.now)]
+        if air_quality.stations:
+            msg_list.append('监测站：')
+            msg_list.extend(
+                AIR_QUALITY_STATION_LINE(station=station)
+                for station in air_quality.stations
+            )
+        return '\n'.join(msg_list)
+
+    return fragment_cache.get_or_render(
+        (city_id, 'air_quality', name),
+        air_quality,
+        render,
+    )
+
+
+def render_air_quality_brief(
+    city_id: str,
+    air_quality: AirQuality.AirQualityInfo,
+) -> str:
+    """定时推送中附带的一行空气质量"""
+    return fragment_cache.get_or_render(
+        (city_id, 'air_quality_brief'),
+        air_quality,
+        lambda: AIR_QUALITY_BRIEF(now=air_quality.now),
+    )
+
+
+def render_weather_alerts(
+    alerts: List[Tuple[str, str, WeatherAlert]],
+) -> str:
+    """一个群在一次轮询中的所有预警变化，alerts为(城市名, 变化类型, 预警)"""
+    return '天气预警：\n' + '\n----------\n'.join(
+        WEATHER_ALERT(name=name, change=change, alert=alert)
+        for name, change, alert in alerts
+    )
+
+
+def render_rain_change(
+    name: str,
+    precipitation: Optional[MinutePrecipitation],
+) -> str:
+    """开始或停止降水的提醒，precipitation为None表示停止降水"""
+    if precipitation is None:
+        return RAIN_STOP(name=name)
+    kind = '下雪' if precipitation.type == 'snow' else '下雨'
+    return RAIN_ONSET(name=name, kind=kind, precipitation=precipitation)
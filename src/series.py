@@ -0,0 +1,146 @@
+from array import array
+from datetime import datetime
+from typing import Any, Dict, List, Union, Optional, Sequence, overload
+
+from .models import CityWeatherApi
+from .utils import construct_trusted
+
+HourlyWeather = CityWeatherApi.HourlyWeather
+
+# 可为空的整数列中表示None的值
+NONE_INT = -(2**31)
+
+
+def _column_typecode(name: str) -> Optional[str]:
+    """数值字段使用array保存，其余字段使用tuple保存"""
+    field = HourlyWeather.__fields__[name]
+    if field.outer_type_ is int:
+        return 'i'
+    if field.outer_type_ is float and not field.allow_none:
+        return 'd'
+    return None
+
+
+_COLUMNS = {name: _column_typecode(name) for name in HourlyWeather.__fields__}
+_NULLABLE_INT_COLUMNS = {
+    name
+    for name, typecode in _COLUMNS.items()
+    if typecode == 'i' and HourlyWeather.__fields__[name].allow_none
+}
+
+
+class HourlyWeatherSeries(Sequence[HourlyWeather]):
+    """按列保存的逐小时天气预报
+
+    每个字段保存为一个数组，只有按下标访问时才构造HourlyWeather对象，
+    比保存24个完整的模型对象占用更少内存，也便于按列计算
+    """
+
+    __slots__ = ('_columns', '_length')
+
+    def __init__(self, columns: Dict[str, Union[array, tuple]]):  # noqa: D107
+        self._columns = columns
+        self._length = len(columns['time'])
+
+    @classmethod
+    def from_rows(cls, rows: List[HourlyWeather]) -> 'HourlyWeatherSeries':
+        """由模型列表构造"""
+        columns = {}
+        for name, typecode in _COLUMNS.items():
+            values = [getattr(row, name) for row in rows]
+            if typecode is None:
+                columns[name] = tuple(values)
+            else:
+                if name in _NULLABLE_INT_COLUMNS:
+                    values = [NONE_INT if v is None else v for v in values]
+                columns[name] = array(typecode, values)
+        return cls(columns)
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, list]) -> 'HourlyWeatherSeries':
+        """由to_columns的结果构造，不做校验"""
+        converted = {}
+        for name, typecode in _COLUMNS.items():
+            values = columns[name]
+            if name == 'time':
+                converted[name] = tuple(map(datetime.fromisoformat, values))
+            elif typecode is None:
+                converted[name] = tuple(values)
+            else:
+                converted[name] = array(typecode, values)
+        return cls(converted)
+
+    def to_columns(self) -> Dict[str, list]:
+        """转换为可json序列化的按列数据"""
+        return {
+            name: (
+                [value.isoformat() for value in column]
+                if name == 'time'
+                else list(column)
+            )
+            for name, column in self._columns.items()
+        }
+
+    def __len__(self) -> int:  # noqa: D105
+        return self._length
+
+    @overload
+    def __getitem__(self, index: int) -> HourlyWeather:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> 'HourlyWeatherSeries':
+        ...
+
+    def __getitem__(self, index):  # noqa: D105
+        if isinstance(index, slice):
+            return HourlyWeatherSeries(
+                {
+                    name: column[index]
+                    for name, column in self._columns.items()
+                },
+            )
+        fields = {}
+        for name, column in self._columns.items():
+            value = column[index]
+            if name in _NULLABLE_INT_COLUMNS and value == NONE_INT:
+                value = None
+            fields[name] = value
+        return construct_trusted(HourlyWeather, fields)
+
+    def __eq__(self, other: Any) -> bool:  # noqa: D105
+        if isinstance(other, HourlyWeatherSeries):
+            return self._columns == other._columns
+        return NotImplemented
+
+    def column(self, name: str) -> List[Any]:
+        """获取某一字段的所有值，可为空的字段中的空值为None"""
+        column = self._columns[name]
+        if name in _NULLABLE_INT_COLUMNS:
+            return [None if v == NONE_INT else v for v in column]
+        return list(column)
+
+    def max_precipitation_probability(
+        self,
+        start: int = 0,
+        end: Optional[int] = None,
+    ) -> Optional[int]:
+        """[start, end)小时内的最大降水概率，没有数据时返回None"""
+        values = [
+            v
+            for v in self._columns['precipitation_probability'][start:end]
+            if v != NONE_INT
+        ]
+        return max(values, default=None)
+
+    def first_rain_time(
+        self,
+        probability_threshold: int = 50,
+    ) -> Optional[datetime]:
+        """第一个有降水量或降水概率不低于阈值的小时，没有时返回None"""
+        precipitation = self._columns['precipitation']
+        probability = self._columns['precipitation_probability']
+        for i in range(self._length):
+            if precipitation[i] > 0 or probability[i] >= probability_threshold:
+                return self._columns['time'][i]
+        return None
@@ -0,0 +1,48 @@
+from typing import Dict
+from urllib.parse import urlsplit
+
+from aiohttp import TCPConnector, ClientSession, ClientTimeout
+
+from .config import config
+from .logger import logger
+
+_sessions: Dict[str, ClientSession] = {}
+
+
+def _create_session() -> ClientSession:
+    connector = TCPConnector(
+        limit=config.CONNECTION_POOL_LIMIT,
+        limit_per_host=config.CONNECTION_POOL_LIMIT_PER_HOST,
+        ttl_dns_cache=config.DNS_CACHE_TTL,
+        keepalive_timeout=config.KEEPALIVE_TIMEOUT,
+    )
+    return ClientSession(
+        connector=connector,
+        timeout=ClientTimeout(total=config.REQUEST_TIMEOUT),
+    )
+
+
+def get_session(url: str) -> ClientSession:
+    """获取url所属host的共享会话，每个host保持一个长连接池"""
+    host = urlsplit(url).netloc
+    session = _sessions.get(host)
+    if session is None or session.closed:
+        session = _create_session()
+        _sessions[host] = session
+        logger.debug(f'为{host}创建连接池')
+    return session
+
+
+async def close_sessions() -> None:
+    """关闭所有共享会话"""
+    for host, session in _sessions.items():
+        if not session.closed:
+            await session.close()
+            logger.debug(f'已关闭{host}的连接池')
+    _sessions.clear()
+
+
+def start_sessions(*urls: str) -> None:
+    """预先为各host创建会话，需在事件循环中调用"""
+    for url in urls:
+        get_session(url)
@@ -1,7 +1,14 @@
 from hashlib import md5
-from typing import Optional
-from json import JSONEncoder
-from datetime import date, datetime
+from pathlib import Path
+from json import JSONEncoder, dump, load
+from inspect import Parameter, signature
+from asyncio import TimerHandle, get_running_loop
+from datetime import date, time, datetime, timezone, timedelta
+from typing import Any, Type, Tuple, TypeVar, Callable, Iterable, Optional
+
+from pydantic import BaseModel
+
+M = TypeVar('M', bound=BaseModel)
 
 
 def generate_cache_name(func_name: str, kwargs: dict) -> str:
@@ -10,11 +17,149 @@ def generate_cache_name(func_name: str, kwargs: dict) -> str:
     return md5(name.encode()).hexdigest()
 
 
+class CacheKeyBuilder:
+    """在装饰时预先解析函数签名，调用时快速生成缓存键
+
+    缓存键为(函数名, 按参数顺序排列并补全默认值的参数值)，
+    只有访问磁盘缓存时才转换为md5缓存名
+    """
+
+    def __init__(self, func: Callable):  # noqa: D107
+        self._func_name = func.__name__
+        self._signature = signature(func)
+        parameters = list(self._signature.parameters.values())
+        self._names = tuple(parameter.name for parameter in parameters)
+        self._name_set = frozenset(self._names)
+        self._positional = tuple(
+            parameter.name
+            for parameter in parameters
+            if parameter.kind
+            in (Parameter.POSITIONAL_ONLY, Parameter.POSITIONAL_OR_KEYWORD)
+        )
+        self._defaults = {
+            parameter.name: parameter.default
+            for parameter in parameters
+            if parameter.default is not Parameter.empty
+        }
+        # 有*args、**kwargs或仅限位置参数时退回到signature.bind
+        self._simple = all(
+            parameter.kind
+            in (Parameter.POSITIONAL_OR_KEYWORD, Parameter.KEYWORD_ONLY)
+            for parameter in parameters
+        )
+
+    def _bind(self, args: tuple, kwargs: dict) -> Tuple:
+        bound = self._signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return (self._func_name, *bound.arguments.values())
+
+    def __call__(self, args: tuple, kwargs: dict) -> Tuple:
+        """生成缓存键，参数不合法时抛出TypeError"""
+        if not self._simple or len(args) > len(self._positional):
+            return self._bind(args, kwargs)
+        values = dict(zip(self._positional, args))
+        for name, value in kwargs.items():
+            if name in values or name not in self._name_set:
+                return self._bind(args, kwargs)
+            values[name] = value
+        try:
+            return (
+                self._func_name,
+                *(
+                    values[name] if name in values else self._defaults[name]
+                    for name in self._names
+                ),
+            )
+        except KeyError:
+            # 缺少必需参数
+            return self._bind(args, kwargs)
+
+    def cache_name(self, key: Tuple) -> str:
+        """将缓存键转换为磁盘缓存使用的缓存名"""
+        return generate_cache_name(
+            self._func_name,
+            dict(zip(self._names, key[1:])),
+        )
+
+
 # subclass JSONEncoder
 class DateTimeEncoder(JSONEncoder):
     """Override the default method to serialize datetime"""
 
     def default(self, obj) -> Optional[str]:  # noqa: D102
-        if isinstance(obj, (date, datetime)):
+        if isinstance(obj, (date, time, datetime)):
             return obj.isoformat()
         return None
+
+
+def construct_trusted(model: Type[M], fields: dict) -> M:
+    """不经校验直接构造模型，fields必须包含模型的所有字段且类型正确"""
+    item = model.__new__(model)
+    object.__setattr__(item, '__dict__', fields)
+    object.__setattr__(item, '__fields_set__', set(fields))
+    return item
+
+
+def seconds_until_next_update(
+    hours: Iterable[int],
+    minute: int,
+    utc_offset: int,
+) -> float:
+    """距离下一个hours中的整点再过minute分钟的秒数，按UTC+utc_offset时区计算"""
+    now = datetime.now(timezone(timedelta(hours=utc_offset)))
+    today = now.replace(minute=0, second=0, microsecond=0)
+    update_times = [
+        today.replace(hour=hour) + timedelta(days=days, minutes=minute)
+        for days in (0, 1)
+        for hour in hours
+    ]
+    next_time = min(
+        update_time for update_time in update_times if update_time > now
+    )
+    return (next_time - now).total_seconds()
+
+
+def load_json(path: Path) -> dict:
+    """读取json文件，文件不存在时返回空字典"""
+    if path.exists():
+        with path.open('r', encoding='utf-8') as f:
+            return load(f)
+    return {}
+
+
+def save_json(path: Path, data: Any) -> None:
+    """先写入临时文件再重命名，保证文件不会写入一半"""
+    tmp_path = path.with_suffix('.tmp')
+    with tmp_path.open('w', encoding='utf-8') as f:
+        dump(data, f, ensure_ascii=False)
+    tmp_path.replace(path)
+
+
+class DelayedSaver:
+    """合并一段时间内的多次修改，只保存一次"""
+
+    def __init__(self, save: Callable[[], None], delay: float):  # noqa: D107
+        self._save = save
+        self._delay = delay
+        self._dirty = False
+        self._handle: Optional[TimerHandle] = None
+
+    def mark_dirty(self) -> None:
+        """标记有修改，在delay秒后保存，没有运行中的事件循环时立即保存"""
+        self._dirty = True
+        try:
+            loop = get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        if self._handle is None:
+            self._handle = loop.call_later(self._delay, self.flush)
+
+    def flush(self) -> None:
+        """立即保存未保存的修改"""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._dirty:
+            self._dirty = False
+            self._save()
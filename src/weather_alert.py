@@ -0,0 +1,62 @@
+from typing import Dict, List, Tuple, Iterable
+
+from .config import config
+from .logger import logger
+from .models import WeatherAlert
+from .define import WEATHER_ALERT_PATH
+from .utils import DelayedSaver, load_json, save_json
+
+# 城市id -> 上次查询到的预警id，包括已解除的预警
+_seen_alerts: Dict[str, List[str]] = load_json(WEATHER_ALERT_PATH)
+
+
+def _save() -> None:
+    save_json(WEATHER_ALERT_PATH, _seen_alerts)
+    logger.debug('已保存已推送的天气预警')
+
+
+_saver = DelayedSaver(_save, config.WATCH_LIST_SAVE_DELAY)
+
+
+def flush_weather_alert() -> None:
+    """立即将已推送的预警写入文件"""
+    _saver.flush()
+
+
+def diff_alerts(
+    city_id: str,
+    alerts: List[WeatherAlert],
+) -> List[Tuple[str, WeatherAlert]]:
+    """与上次推送的预警对比，返回需要推送的(变化类型, 预警)
+
+    变化类型为新发布、更新或解除；已不在返回结果中的预警视为自然过期，不推送
+    """
+    is_new_city = city_id not in _seen_alerts
+    seen = set(_seen_alerts.get(city_id, ()))
+    changes = []
+    for alert in alerts:
+        if alert.id in seen:
+            continue
+        if alert.status == 'cancel':
+            # 第一次查询的城市没有推送过原预警，不推送解除
+            if not is_new_city:
+                changes.append(('解除', alert))
+        elif alert.status == 'update' or alert.related in seen:
+            changes.append(('更新', alert))
+        else:
+            changes.append(('新发布', alert))
+    current = [alert.id for alert in alerts]
+    if is_new_city or set(current) != seen:
+        _seen_alerts[city_id] = current
+        _saver.mark_dirty()
+    return changes
+
+
+def prune_alert_state(city_ids: Iterable[str]) -> None:
+    """移除已经没有群关注的城市"""
+    city_ids = set(city_ids)
+    removed = [city_id for city_id in _seen_alerts if city_id not in city_ids]
+    for city_id in removed:
+        del _seen_alerts[city_id]
+    if removed:
+        _saver.mark_dirty()